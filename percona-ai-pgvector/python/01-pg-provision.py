@@ -1,6 +1,8 @@
 import psycopg2
 from pgvector.psycopg2 import register_vector
 import config
+import indexes
+import dedup
 conn = psycopg2.connect(
     user=config.PGUSER,
     password=config.PGPASSWORD,
@@ -9,53 +11,382 @@ conn = psycopg2.connect(
     port=config.PGPORT,
 )
 cur = conn.cursor()
-cur.execute("SET search_path TO " + 'test')
+cur.execute("SET search_path TO " + config.PGSCHEMA)
 conn.commit()
 
+quantized = indexes.QUANTIZED.get(config.QUANTIZED_STORAGE)
+
+if config.PARTITION_BY_SOURCE and config.NEAR_DUP_DISTANCE is not None:
+    print('warning: with PARTITION_BY_SOURCE near duplicates are only found within a source, not across docs repos')
+
+# with config.PARTITION_BY_SOURCE the primary key has to include the
+# partition key. With config.NORMALIZED_LAYOUT (see documents.py) url and
+# metadata live in documents and the text in chunk_texts
+if config.NORMALIZED_LAYOUT:
+    columns = """
+    doc_id bigint not null,
+    chunk_no int,"""
+else:
+    columns = """
+    content text,
+    url text,"""
 cur.execute("""
   create table perconavec (
+    id bigserial,%s
+    source text not null,
+    content_hash text,
+    embedding vector(%d),%s
+    simhash bigint,
+    simhash_bands int[] generated always as (%s) stored,
+    duplicate_of bigint,%s
+    primary key (id%s)
+  )%s;
+""" % (
+    columns,
+    config.EMBED_DIMENSIONS,
+    '' if config.NORMALIZED_LAYOUT else """
+    source_type text,
+    repo text,
+    branch text,
+    published_at timestamptz,""",
+    dedup.BANDS_SQL,
+    '\n    ' + quantized['column'] + ',' if quantized else '',
+    ', source' if config.PARTITION_BY_SOURCE else '',
+    ' partition by list (source)' if config.PARTITION_BY_SOURCE else '',
+))
+if config.PARTITION_BY_SOURCE:
+    for table, source in indexes.partitions([indexes.BLOG_SOURCE] + [doc['repo'] for doc in config.DOCS]):
+        cur.execute('create table %s partition of perconavec for values in (%%s)' % table, (source,))
+    cur.execute('create table perconavec_default partition of perconavec default')
+conn.commit()
+
+if config.NORMALIZED_LAYOUT:
+    # chunk text is only read for the rows a search returns: stored out of
+    # line and compressed as soon as a row passes toast_tuple_target
+    cur.execute("""
+      create table documents (
+        id bigserial primary key,
+        url text not null unique,
+        source text not null,
+        source_type text,
+        repo text,
+        branch text,
+        published_at timestamptz
+      );
+      create index on documents (source_type);
+      create index on documents (repo, branch);
+      create index on documents (published_at);
+      create table chunk_texts (
+        id bigint primary key,
+        content text
+      ) with (toast_tuple_target = %d);
+      create index on perconavec (doc_id);
+    """ % config.CHUNK_TEXT_TOAST_TARGET)
+    if config.CHUNK_TEXT_COMPRESSION:
+        # the methods the server was built with
+        cur.execute("select enumvals from pg_settings where name = 'default_toast_compression'")
+        row = cur.fetchone()
+        if row and config.CHUNK_TEXT_COMPRESSION in row[0]:
+            cur.execute('alter table chunk_texts alter column content set compression %s' % config.CHUNK_TEXT_COMPRESSION)
+        else:
+            print('chunk_texts: compression %s not available, keeping the default' % config.CHUNK_TEXT_COMPRESSION)
+else:
+    cur.execute("""
+      create index on perconavec (url);
+      create index on perconavec (source_type);
+      create index on perconavec (repo, branch);
+      create index on perconavec (published_at);
+    """)
+cur.execute("""
+  create index on perconavec (content_hash);
+  create index on perconavec using gin (simhash_bands) where duplicate_of is null;
+  create index on perconavec (duplicate_of);
+""")
+conn.commit()
+
+cur.execute("""
+  create table ingest_state (
+    url text primary key,
+    lastmod text,
+    etag text,
+    last_modified text,
+    content_hash text,
+    updated_at timestamptz default now()
+  );
+""")
+conn.commit()
+
+# settings the data was ingested with, see 06-generation.py
+cur.execute("""
+  create table generation (
+    embed_model text,
+    chunk_tokens int,
+    chunk_overlap_tokens int,
+    created_at timestamptz default now(),
+    swapped_at timestamptz
+  );
+""")
+cur.execute('insert into generation (embed_model, chunk_tokens, chunk_overlap_tokens) values (%s, %s, %s)',
+            (config.EMBED_MODEL, config.CHUNK_TOKENS, config.CHUNK_OVERLAP_TOKENS))
+conn.commit()
+
+# work queue of 02-put.py --enqueue / --worker, see jobs.py
+cur.execute("""
+  create table ingest_jobs (
     id bigserial primary key,
-    content text,
-    url text,
-    embedding vector(1024)
+    url text not null unique,
+    kind text not null,
+    source text not null,
+    payload jsonb not null,
+    status text not null default 'pending',
+    attempts int not null default 0,
+    leased_by text,
+    lease_until timestamptz,
+    last_error text,
+    created_at timestamptz default now(),
+    updated_at timestamptz default now()
   );
+  create index on ingest_jobs (id) where status in ('pending', 'running');
+  create index on ingest_jobs (leased_by) where status = 'running';
 """)
 conn.commit()
 
+cur.execute("""
+  create table docs_state (
+    repo text,
+    branch text,
+    commit text,
+    updated_at timestamptz default now(),
+    primary key (repo, branch)
+  );
+""")
+conn.commit()
+
+# functions are replaced in the schema provisioned here only, not in one
+# further down the search_path (06-generation.py, bench-ingest.py)
+schema = indexes.schema(conn)
+
+# conditions are templates on {chunk}, a perconavec row, and {doc}, the
+# document it belongs to: the row itself, or its documents row with the
+# normalized layout
+def condition(cond, chunk):
+    if not config.NORMALIZED_LAYOUT or '{doc}' not in cond:
+        return cond.format(chunk=chunk, doc=chunk)
+    doc = chunk + '_doc'
+    return 'exists (select 1 from documents %s where %s.id = %s.doc_id and %s)' % (doc, doc, chunk, cond.format(chunk=chunk, doc=doc))
+
+# near duplicates (see dedup.py) have no embedding: a filter matches a
+# canonical row when the row or one of its duplicates passes it, and every
+# result comes with the urls of its duplicates. With config.PARTITION_BY_SOURCE
+# duplicates share the source of their canonical row, so a source condition
+# stays a plain one the planner prunes partitions with
+def matching(cond, source=False):
+    if config.NEAR_DUP_DISTANCE is None or (source and config.PARTITION_BY_SOURCE):
+        return condition(cond, 'perconavec')
+    return '(%s or exists (select 1 from perconavec d where d.duplicate_of = perconavec.id and %s))' % (condition(cond, 'perconavec'), condition(cond, 'd'))
+
+# url is the url of the result row, table the query row it comes from
+def urls(url, table):
+    if config.NEAR_DUP_DISTANCE is None:
+        return 'array[%s]' % url
+    if config.NORMALIZED_LAYOUT:
+        return 'array[%s] || array(select dd.url from perconavec d join documents dd on dd.id = d.doc_id where d.duplicate_of = %s.id order by d.id)' % (url, table)
+    return 'array[%s] || array(select d.url from perconavec d where d.duplicate_of = %s.id order by d.id)' % (url, table)
+
+# the search query, with the function arguments it uses given by name or, for
+# dynamic sql, by position. With quantized storage the index on embedding_q
+# returns count * rerank candidates that are re-ranked with the full precision
+# embedding. With the normalized layout the ranking reads perconavec only,
+# text and url are joined to the match_count rows it returns
+def search_query(filters, query='query_embedding', threshold='match_threshold', count='match_count', rerank='rerank_factor'):
+    columns = ['id', 'doc_id'] if config.NORMALIZED_LAYOUT else ['id', 'content', 'url']
+    if quantized:
+        sql = """
+      with candidates as (
+        select %s, perconavec.embedding
+        from perconavec
+        where perconavec.embedding is not null%s
+        order by %s
+        limit {count} * {rerank}
+      )
+      select
+        %s,
+        1 - (candidates.embedding <=> {query}) as similarity%s
+      from candidates
+      where
+        candidates.embedding <=> {query} < 1 - {threshold}
+        order by candidates.embedding <=> {query}
+      limit {count}
+        """ % (
+            ', '.join('perconavec.' + column for column in columns),
+            ''.join('\n          and ' + f for f in filters),
+            quantized['distance'],
+            ',\n        '.join('candidates.' + column for column in columns),
+            '' if config.NORMALIZED_LAYOUT else ',\n        %s as urls' % urls('candidates.url', 'candidates'))
+    else:
+        sql = """
+      select
+        %s,
+        1 - (perconavec.embedding <=> {query}) as similarity%s
+      from perconavec
+      where
+        perconavec.embedding <=> {query} < 1 - {threshold}%s
+        order by perconavec.embedding <=> {query}
+      limit {count}
+        """ % (
+            ',\n        '.join('perconavec.' + column for column in columns),
+            '' if config.NORMALIZED_LAYOUT else ',\n        %s as urls' % urls('perconavec.url', 'perconavec'),
+            ''.join('\n        and ' + f for f in filters))
+    if config.NORMALIZED_LAYOUT:
+        sql = """
+      select
+        ranked.id,
+        chunk_texts.content,
+        documents.url,
+        ranked.similarity,
+        %s as urls
+      from (%s) ranked
+      join documents on documents.id = ranked.doc_id
+      join chunk_texts on chunk_texts.id = ranked.id
+      order by ranked.similarity desc
+        """ % (urls('documents.url', 'ranked'), sql.strip())
+    return (sql.strip() + ';').format(query=query, threshold=threshold, count=count, rerank=rerank)
+
+# probes and ef_search are applied to the calling transaction only, like
+# SET LOCAL, and are left at the server defaults when null; an hnsw scan
+# returns at most hnsw.ef_search rows though, so without ef_search it is
+# raised to the rows the query asks the index for (the re-rank candidates
+# with quantized storage), up to pgvector's limit of 1000. sources limits
+# the search to those sources, and to their partitions when perconavec is
+# partitioned
+ef_search_rows = 'match_count * rerank_factor' if quantized else 'match_count'
+for signature in ['(vector, float, int)', '(vector, float, int, int, int)', '(vector, float, int, int, int, int)', '(vector, float, int, int, int, int, text[])']:
+    cur.execute('drop function if exists %s.match_documents%s' % (schema, signature))
 cur.execute("""
    create or replace function match_documents (
-      query_embedding vector(1024),
+      query_embedding vector(%d),
       match_threshold float,
-      match_count int
+      match_count int,
+      probes int default null,
+      ef_search int default null,
+      rerank_factor int default %d,
+      sources text[] default null
     )
     returns table (
       id bigint,
       content text,
       url text,
-      similarity float
+      similarity float,
+      urls text[]
     )
-    language sql stable
+    language plpgsql
      as $$
-    select
-      perconavec.id,
-      perconavec.content,
-      perconavec.url,
-      1 - (perconavec.embedding <=> query_embedding) as similarity
-    from perconavec
-    where
-      perconavec.embedding <=> query_embedding < 1 - match_threshold
-      order by perconavec.embedding <=> query_embedding
-    limit match_count;
+    begin
+      if probes is not null then
+        perform set_config('ivfflat.probes', probes::text, true);
+      end if;
+      if ef_search is not null then
+        perform set_config('hnsw.ef_search', ef_search::text, true);
+      else
+        perform set_config('hnsw.ef_search', least(1000, greatest(coalesce(current_setting('hnsw.ef_search', true)::int, 40), %s))::text, true);
+      end if;
+      if sources is null then
+        return query
+      %s
+      else
+        return query
+      %s
+      end if;
+    end;
     $$;
-""")
+""" % (config.EMBED_DIMENSIONS, config.RERANK_FACTOR, ef_search_rows, search_query([]), search_query([matching('{chunk}.source = any(sources)', source=True)])))
 conn.commit()
 
+# metadata filters applied inside the ann query. Only the given filters end up
+# in the query, which is planned for the actual values, so the metadata
+# indexes and partition pruning (repos are sources) can be used. With an ann
+# index the filters apply to the candidates it returns; iterative_scan
+# ('relaxed_order' or 'strict_order', pgvector 0.8+) keeps the index scanning
+# until match_count rows pass them
+filtered_query = search_query(["true' || filters || '"], '$1', '$2', '$3', '$4')
+cur.execute('drop function if exists %s.match_documents_filtered' % schema)
 cur.execute("""
-    create index on perconavec using ivfflat (embedding vector_cosine_ops)
-    with
-      (lists = 100);
-""")
+   create function match_documents_filtered (
+      query_embedding vector(%d),
+      match_threshold float,
+      match_count int,
+      source_types text[] default null,
+      repos text[] default null,
+      branches text[] default null,
+      published_after timestamptz default null,
+      published_before timestamptz default null,
+      probes int default null,
+      ef_search int default null,
+      rerank_factor int default %d,
+      iterative_scan text default null
+    )
+    returns table (
+      id bigint,
+      content text,
+      url text,
+      similarity float,
+      urls text[]
+    )
+    language plpgsql
+     as $$
+    declare
+      filters text := '';
+    begin
+      if probes is not null then
+        perform set_config('ivfflat.probes', probes::text, true);
+      end if;
+      if ef_search is not null then
+        perform set_config('hnsw.ef_search', ef_search::text, true);
+      else
+        perform set_config('hnsw.ef_search', least(1000, greatest(coalesce(current_setting('hnsw.ef_search', true)::int, 40), %s))::text, true);
+      end if;
+      if iterative_scan is not null then
+        perform set_config('ivfflat.iterative_scan', iterative_scan, true);
+        perform set_config('hnsw.iterative_scan', iterative_scan, true);
+      end if;
+      if source_types is not null then
+        filters := filters || ' and %s';
+      end if;
+      if repos is not null then
+        filters := filters || ' and %s';
+      end if;
+      if branches is not null then
+        filters := filters || ' and %s';
+      end if;
+      if published_after is not null then
+        filters := filters || ' and %s';
+      end if;
+      if published_before is not null then
+        filters := filters || ' and %s';
+      end if;
+      return query execute '%s'
+      using query_embedding, match_threshold, match_count, rerank_factor,
+        source_types, repos, branches, published_after, published_before;
+    end;
+    $$;
+""" % (
+    config.EMBED_DIMENSIONS,
+    config.RERANK_FACTOR,
+    ef_search_rows,
+    matching('{doc}.source_type = any($5)'),
+    matching('{chunk}.source = any($6)', source=True),
+    matching('{doc}.branch = any($7)'),
+    matching('{doc}.published_at >= $8'),
+    matching('{doc}.published_at < $9'),
+    filtered_query,
+))
 conn.commit()
 
+# an hnsw index needs no training and is created right away; the ivfflat
+# index is built by 02-put.py after the first load, centroids trained on an
+# empty table give poor recall
+if config.INDEX_TYPE == 'hnsw':
+    indexes.build_index(conn)
+
 cur.close()
 conn.close()
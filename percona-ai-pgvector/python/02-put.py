@@ -1,153 +1,417 @@
 # create vector embedding from string
-from sentence_transformers import SentenceTransformer
 import config
-from langchain.text_splitter import MarkdownTextSplitter, RecursiveCharacterTextSplitter
-import re
-from bs4 import BeautifulSoup
-import xmltodict
-import requests
+import embedding
+import loader
+import crawler
+import state
+import chunk_cache
+import pipeline
+import docs_git
+import extract
+import indexes
+import chunking
+import metrics
+import dedup
+import documents
+import jobs
+import itertools
+import os
+import sys
+import threading
+import time
+from datetime import datetime
 import psycopg2
 from pgvector.psycopg2 import register_vector
 
+# usage: python 02-put.py [--bulk] [--rechunk] [--enqueue | --worker | --jobs] [source ...]
+# sources ('blog' or a docs repo such as percona/psmdb-docs) limit the run to
+# those products, everything is ingested by default. --rechunk ignores the
+# saved page state and commits, so every page is chunked again after the
+# chunking settings changed; unchanged chunks keep their rows.
+# --enqueue and --worker split a run over processes and nodes through the
+# ingest_jobs queue (jobs.py): --enqueue finds the changed pages like a normal
+# run and queues them, every --worker process claims and ingests jobs until
+# none are left. --jobs prints the queue progress, with --retry-failed failed
+# jobs are queued again first
+sources = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+rechunk = '--rechunk' in sys.argv
+enqueue = '--enqueue' in sys.argv
+worker = jobs.worker_name() if '--worker' in sys.argv else None
+show_jobs = '--jobs' in sys.argv
 
-model = SentenceTransformer('WhereIsAI/UAE-Large-V1')
-def create_embedding(content):
-    embeddings = model.encode([content], device='cuda', show_progress_bar=True)
-    return(embeddings)
+# per stage and step counters, see config.METRICS_INTERVAL and METRICS_REPORT
+stats = metrics.Metrics()
 
-conn = psycopg2.connect(
-    user=config.PGUSER,
-    password=config.PGPASSWORD,
-    database=config.PGDATABASE,
-    host=config.PGHOST,
-    port=config.PGPORT,
-)
-cur = conn.cursor()
-cur.execute("SET search_path TO " + 'test')
-register_vector(conn)
+# forks the cpu encode workers, if any, before threads and connections exist;
+# a model that does not fit the vector columns stops the run before any work
+if not enqueue and not show_jobs:
+	embedding.start_cpu_pool()
+	embedding.check_dimensions()
 
-def put_embedding(url, text, pgcur):
+# every pipeline worker thread gets its own connection and embedding cache
+local = threading.local()
 
-	embeddings = create_embedding(text)
-	cur.execute('INSERT INTO perconavec (content, url, embedding) VALUES (%s,%s,%s)', (text, url, embeddings[0],))
+def get_conn():
+	if not hasattr(local, 'conn'):
+		local.conn = psycopg2.connect(
+		    user=config.PGUSER,
+		    password=config.PGPASSWORD,
+		    database=config.PGDATABASE,
+		    host=config.PGHOST,
+		    port=config.PGPORT,
+		)
+		local.conn.cursor().execute("SET search_path TO " + config.PGSCHEMA)
+		register_vector(local.conn)
+	return local.conn
+
+def get_cache():
+	if not hasattr(local, 'cache'):
+		local.cache = chunk_cache.EmbeddingCache(get_conn())
+	return local.cache
+
+def get_deduper():
+	if not hasattr(local, 'deduper'):
+		local.deduper = dedup.Deduper(get_conn())
+	return local.deduper
 
-pages = []
-max_pages = 20
 #########################
 # Parsing Percona Blogs #
 #########################
 
-# from blog post - remove noisy divs
-def extract_text_from_blog(url):
-    html = requests.get(url).text
-    soup = BeautifulSoup(html, features="html.parser")
+# blog html -> text, see config.HTML_EXTRACTOR
+extract_text_from_blog = extract.get_extractor()
 
-    for div in soup.find_all("div", {"id": "jp-relatedposts"}):
-        div.decompose()
-    for div in soup.find_all("div", {"class": "share-wrap"}):
-        div.decompose()
-    for div in soup.find_all("div", {"class": "comments-sec"}):
-        div.decompose()
+# chunks of up to config.CHUNK_TOKENS model tokens, see chunking.py
+def get_blog_chunks(content):
+	return chunking.blog_chunks(content)
 
-    text = soup.find("div", {"class": "blog-content-inner"}).get_text()
+# sitemaps and pages are fetched concurrently by crawler.blog_pages(), pages
+# with an unchanged sitemap lastmod or a 304 answer come without html
+# --worker runs load the state of the pages they claim
+known = {} if rechunk or worker or show_jobs else state.load_state(get_conn())
 
-    lines = (line.strip() for line in text.splitlines())
-    return '\n'.join(line for line in lines if line)
+def blog_pages():
+	if sources and indexes.BLOG_SOURCE not in sources:
+		return
+	for page in crawler.blog_pages(known):
+		page['kind'] = 'blog'
+		page['source'] = indexes.BLOG_SOURCE
+		if page['html'] is not None:
+			stats.add('blog', bytes=len(page['html']))
+		yield page
 
-def get_blog_chunks(content):
-	
-	text_splitter = RecursiveCharacterTextSplitter(chunk_size=250, chunk_overlap=20)
-	chunks = text_splitter.create_documents([content])
-	return chunks
-
-r = requests.get("https://www.percona.com/blog/sitemap_index.xml")
-xml = r.text
-rootxml = xmltodict.parse(xml)
-
-for xmlurl in rootxml['sitemapindex']['sitemap']:
-	r = requests.get(xmlurl['loc'])
-	xml = r.text
-	raw = xmltodict.parse(xml)
-	for info in raw['urlset']['url']:
-		if len(pages) == max_pages:
-			for page in pages:
-				chunks = get_blog_chunks(page['text'])
-				for chunk in chunks:
-					print(page['source'])
-					put_embedding(page['source'], chunk.page_content, cur)
-					conn.commit()
-			pages = []
-		url = info['loc']
-		if 'https://www.percona.com/blog/' in url:
-			pages.append({'text': extract_text_from_blog(url), 'source': url})
-
-if pages:
-	chunks = get_blog_chunks(page['text'])
-	for chunk in chunks:
-		print(page['source'])
-		put_embedding(page['source'], chunk.page_content, cur)
-		conn.commit()
-	pages = []
 ########################
 # Parsing Percona Docs #
 ########################
 
-# extract md paths and urls
-def get_md_docs(doc):
+def get_doc_chunks(content):
+	return chunking.doc_chunks(content)
+
 
-	md_docs = []
-	api_url = 'https://api.github.com/repos/%s/git/trees/%s?recursive=1' % (doc['repo'], doc['branch'])
-	r = requests.get(api_url)
-	for file in r.json()['tree']:
-		m = re.search(r'docs/.*\.md', file['path'])
-		if m:
-			md_docs.append({'path': file['path'], 'url': file['url']})
-	return md_docs
+# docs come from shallow clones kept under config.DOCS_CLONE_DIR; only files
+# changed since the last ingested commit of a repo/branch are re-chunked and
+# rows of deleted files are removed
+doc_commits = {} if rechunk or worker or show_jobs else docs_git.load_commits(get_conn())
+# repo/branch -> [head commit, files still in the pipeline]
+docs_left = {}
+docs_lock = threading.Lock()
 
-def get_md_content(url):
-	md = requests.get(url).text
-	return md
+def doc_pages():
+	for doc in config.DOCS:
+		if sources and doc['repo'] not in sources:
+			continue
+		path = docs_git.update_clone(doc)
+		head = docs_git.head_commit(path)
+		key = (doc['repo'], doc['branch'])
+		if doc_commits.get(key) == head:
+			continue
+		changed, deleted = docs_git.changed_files(path, doc_commits.get(key), lambda: docs_git.stored_files(get_conn(), doc))
+		if not changed and not deleted:
+			with get_conn().cursor() as cur:
+				docs_git.save_commit(cur, doc['repo'], doc['branch'], head)
+			get_conn().commit()
+			continue
+		with docs_lock:
+			docs_left[key] = [head, len(changed) + len(deleted)]
+		published_at = docs_git.commit_time(path)
+		for name, deleted_file in [(name, False) for name in changed] + [(name, True) for name in deleted]:
+			url = docs_git.file_url(doc, name)
+			yield {'kind': 'doc', 'url': url, 'source': doc['repo'], 'repo': doc['repo'], 'branch': doc['branch'], 'path': path, 'file': name, 'deleted': deleted_file, 'text': None, 'published_at': published_at}
 
-def get_doc_chunks(content):
-	markdown_splitter = MarkdownTextSplitter(chunk_size=200, chunk_overlap=0)
-	chunks = markdown_splitter.create_documents([content])
-	return chunks
-
-# parse docs
-docs = [
-	{'repo': 'percona-platform/portal-doc', 'branch': 'main'},
-	{'repo': 'percona/pmm-doc', 'branch': 'main'},
-	{'repo': 'percona/pdmysql-docs', 'branch': 'innovation-release'},
-	{'repo': 'percona/pxc-docs', 'branch': '8.0'},
-	{'repo': 'percona/pxb-docs', 'branch': 'innovation-release'},
-	{'repo': 'percona/proxysql-admin-tool-doc', 'branch': 'main'},
-	{'repo': 'percona/distmongo-docs', 'branch': '7.0'},
-	{'repo': 'percona/psmdb-docs', 'branch': '7.0'},
-	{'repo': 'percona/pbm-docs', 'branch': 'main'},
-	{'repo': 'percona/postgresql-docs', 'branch': '16'},
-	{'repo': 'percona/k8sps-docs', 'branch': 'main'},
-	{'repo': 'percona/k8spsmdb-docs', 'branch': 'main'},
-	{'repo': 'percona/k8spxc-docs', 'branch': 'main'},
-	{'repo': 'percona/k8spg-docs', 'branch': 'main'},
-	{'repo': 'percona/everest-doc', 'branch': 'main'},
-	{'repo': 'percona/psmysql-docs', 'branch': 'innovation-release'}
+# a repo/branch commit is saved once the last of its files is written; with
+# the queue --enqueue saves it as soon as the files are queued
+def save_finished_docs(pages):
+	if worker:
+		return
+	finished = []
+	with docs_lock:
+		for page in pages:
+			if page['kind'] == 'doc':
+				key = (page['repo'], page['branch'])
+				docs_left[key][1] -= 1
+				if docs_left[key][1] == 0:
+					finished.append((key, docs_left.pop(key)[0]))
+	if finished:
+		with get_conn().cursor() as cur:
+			for (repo, branch), head in finished:
+				docs_git.save_commit(cur, repo, branch, head)
+		get_conn().commit()
+
+#############
+# Job queue #
+#############
+
+# --enqueue: blog pages whose sitemap lastmod moved and changed docs files
+# become jobs, fetched and parsed by the workers
+def enqueue_jobs():
+	pages = []
+	if not sources or indexes.BLOG_SOURCE in sources:
+		for page in crawler.sitemap_list():
+			if page['lastmod'] and page['lastmod'] == known.get(page['url'], {}).get('lastmod'):
+				continue
+			pages.append({'url': page['url'], 'kind': 'blog', 'source': indexes.BLOG_SOURCE, 'payload': {'lastmod': page['lastmod'], 'rechunk': rechunk}})
+	for page in doc_pages():
+		head = docs_left[(page['repo'], page['branch'])][0]
+		payload = {'repo': page['repo'], 'branch': page['branch'], 'file': page['file'], 'deleted': page['deleted'], 'commit': head, 'published_at': page['published_at'].isoformat()}
+		pages.append({'url': page['url'], 'kind': 'doc', 'source': page['source'], 'payload': payload})
+	with get_conn().cursor() as cur:
+		if pages:
+			jobs.enqueue(cur, pages)
+		for (repo, branch), (head, left) in docs_left.items():
+			docs_git.save_commit(cur, repo, branch, head)
+	get_conn().commit()
+	return pages
+
+# clone of a docs job's repo/branch that has the job's commit, fetched at
+# most once per commit and process
+doc_clones = {}
+
+def job_clone(payload):
+	key = (payload['repo'], payload['branch'], payload['commit'])
+	with docs_lock:
+		if key not in doc_clones:
+			doc = {'repo': payload['repo'], 'branch': payload['branch']}
+			path = docs_git.clone_dir(doc)
+			if not os.path.isdir(os.path.join(path, '.git')) or not docs_git.has_commit(path, payload['commit']):
+				path = docs_git.update_clone(doc)
+			doc_clones[key] = path
+		return doc_clones[key]
+
+# --worker: claimed jobs as pages, blog pages fetched a claim at a time. The
+# worker stops once no job is pending or running anywhere, its own included
+def job_pages():
+	while True:
+		claimed = jobs.claim(get_conn(), worker)
+		if not claimed:
+			if not jobs.unfinished(get_conn()):
+				return
+			time.sleep(config.JOB_POLL_INTERVAL)
+			continue
+		blog = [job for job in claimed if job['kind'] == 'blog']
+		blog_known = state.load_state(get_conn(), [job['url'] for job in blog if not job['payload']['rechunk']])
+		get_conn().commit()
+		known.update(blog_known)
+		fetched = crawler.fetch_pages([{'url': job['url'], 'lastmod': job['payload']['lastmod'], 'html': None, 'job': job['id']} for job in blog], blog_known)
+		for page in fetched:
+			if 'error' in page:
+				print('failed to fetch %s: %s' % (page['url'], page['error']))
+				jobs.fail(get_conn(), page['job'], worker, page['error'])
+				continue
+			page['kind'] = 'blog'
+			page['source'] = indexes.BLOG_SOURCE
+			if page['html'] is not None:
+				stats.add('jobs', bytes=len(page['html']))
+			yield page
+		for job in claimed:
+			if job['kind'] != 'doc':
+				continue
+			payload = job['payload']
+			# a clone that cannot be fetched fails the job, like job_guard
+			try:
+				path = job_clone(payload)
+			except Exception as e:
+				print('failed to clone %s: %s' % (payload['repo'], e))
+				jobs.fail(get_conn(), job['id'], worker, '%s: %s' % (type(e).__name__, e))
+				continue
+			yield {'kind': 'doc', 'url': job['url'], 'source': job['source'], 'repo': payload['repo'], 'branch': payload['branch'], 'path': path, 'file': payload['file'], 'deleted': payload['deleted'], 'text': None, 'published_at': datetime.fromisoformat(payload['published_at']), 'job': job['id']}
+
+# a page that fails in a per-page stage fails its job, to be retried later,
+# instead of stopping the worker
+def job_guard(func):
+	def run(page):
+		try:
+			yield from list(func(page))
+		except Exception as e:
+			if 'job' not in page:
+				raise
+			get_conn().rollback()
+			print('failed to ingest %s: %s' % (page['url'], e))
+			jobs.fail(get_conn(), page['job'], worker, '%s: %s' % (type(e).__name__, e))
+	return run
+
+############
+# Pipeline #
+############
+
+# fetch -> parse -> dedup -> embed -> write, every stage with its own worker
+# threads; pages travel whole so the writer can replace a page in one
+# transaction
+
+def fetch(page):
+	if page['kind'] == 'doc' and not page['deleted']:
+		page['text'] = docs_git.read_file(page['path'], page['file'])
+		stats.add('fetch', bytes=len(page['text']))
+	yield page
+
+# pages whose extracted text did not change are passed on with no chunks,
+# only to have their state saved
+def parse(page):
+	url = page['url']
+	page['chunks'], page['stale'] = [], []
+	if page['kind'] == 'blog':
+		html = page.pop('html')
+		if html is None:
+			page['content_hash'] = known[url]['content_hash']
+			yield page
+			return
+		with stats.timed('parse.extract', bytes=len(html)):
+			text = extract_text_from_blog(html)
+			page['published_at'] = extract.published_time(html)
+		page['content_hash'] = state.content_hash(text)
+		if url in known and page['content_hash'] == known[url]['content_hash']:
+			yield page
+			return
+		with stats.timed('parse.split', bytes=len(text)):
+			chunks = get_blog_chunks(text)
+	elif page['deleted']:
+		chunks = []
+	else:
+		text = page.pop('text')
+		with stats.timed('parse.split', bytes=len(text)):
+			chunks = get_doc_chunks(text)
+	with stats.timed('parse.diff', chunks=len(chunks)), get_conn().cursor() as cur:
+		page['chunks'], page['stale'] = chunk_cache.diff_chunks(cur, url, page['source'], [chunk.page_content for chunk in chunks])
+	get_conn().commit()
+	# metadata for match_documents_filtered
+	for chunk in page['chunks']:
+		chunk.update(source_type=page['kind'], repo=page.get('repo'), branch=page.get('branch'), published_at=page.get('published_at'))
+	yield page
+
+# near duplicates of stored or earlier chunks are marked, see
+# config.NEAR_DUP_DISTANCE
+def mark_duplicates(pages):
+	get_deduper().dedup(pages)
+	chunks = [chunk for page in pages for chunk in page['chunks']]
+	stats.add('dedup', chunks=len(chunks), duplicates=sum(1 for chunk in chunks if chunk['duplicate_of'] is not None))
+	yield from pages
+
+# chunks from many pages are encoded together, config.EMBED_BATCH_SIZE at a
+# time, reusing cached embeddings by content hash
+def embed(pages):
+	chunks = [chunk for page in pages for chunk in page['chunks']]
+	embedding.embed_batch(chunks, get_cache())
+	stats.add('embed', chunks=len(chunks))
+	get_conn().commit()
+	yield from pages
+
+# stale rows, new chunks and page state go in one transaction,
+# config.COPY_BATCH_SIZE rows at a time
+def write(pages):
+	conn = get_conn()
+	with conn.cursor() as cur:
+		if worker:
+			# jobs whose lease ran out were claimed by another worker
+			owned = jobs.lock_owned(cur, [page['job'] for page in pages], worker)
+			pages = [page for page in pages if page['job'] in owned]
+			jobs.complete(cur, list(owned))
+		stale = [id for page in pages for id in page['stale']]
+		if stale:
+			with stats.timed('write.delete', rows=len(stale)):
+				if config.NEAR_DUP_DISTANCE is None:
+					cur.execute('DELETE FROM perconavec WHERE id = ANY(%s)', (stale,))
+					if config.NORMALIZED_LAYOUT:
+						documents.delete_texts(cur, stale)
+				else:
+					dedup.delete_rows(cur, stale)
+		if config.NORMALIZED_LAYOUT:
+			# metadata goes to the documents row of a page instead of its chunks
+			gone = [page['url'] for page in pages if page.get('deleted')]
+			if gone:
+				documents.delete(cur, gone)
+			changed = [page for page in pages if (page['chunks'] or page['stale']) and not page.get('deleted')]
+			if changed:
+				doc_ids = documents.save(cur, changed)
+				for page in changed:
+					for chunk in page['chunks']:
+						chunk['doc_id'] = doc_ids[page['url']]
+		state.save_state(cur, [page for page in pages if page['kind'] == 'blog'])
+		rows = [chunk for page in pages for chunk in page['chunks']]
+		if config.NEAR_DUP_DISTANCE is not None:
+			# duplicates of rows deleted meanwhile or never written
+			orphans = dedup.attach(cur, rows)
+			if orphans:
+				embedding.embed_batch(orphans, get_cache())
+	with stats.timed('write.copy', rows=len(rows)):
+		loader.copy_rows(conn, rows)
+	save_finished_docs(pages)
+	yield from pages
+
+def chunk_count(page):
+	return max(1, len(page['chunks']))
+
+stages = [
+	pipeline.Stage('fetch', job_guard(fetch) if worker else fetch, config.FETCH_WORKERS),
+	pipeline.Stage('parse', job_guard(parse) if worker else parse, config.PARSE_WORKERS),
+	pipeline.Stage('embed', embed, config.EMBED_WORKERS, config.EMBED_BATCH_SIZE, chunk_count),
+	pipeline.Stage('write', write, config.WRITE_WORKERS, config.COPY_BATCH_SIZE, chunk_count),
 ]
-pages = []
-for doc in docs:
-
-	md_docs = get_md_docs(doc)
-	for md_doc in md_docs:
-		url = "https://raw.githubusercontent.com/%s/%s/%s" % (doc['repo'], doc['branch'], md_doc['path'])
-		pages.append({'source': "https://raw.githubusercontent.com/%s/%s/%s" % (doc['repo'], doc['branch'], md_doc['path']), 'text': get_md_content(url)})
-		if len(pages) == max_pages:
-			for page in pages:
-				chunks = get_doc_chunks(page['text'])
-				for chunk in chunks:
-					print(page['source'])
-					put_embedding(page['source'], chunk.page_content, cur)
-					conn.commit()
-			pages = []
-
-conn.commit()
-cur.close()
-conn.close()
+if config.NEAR_DUP_DISTANCE is not None:
+	# one worker, so chunks of concurrent pages are compared with each other
+	stages.insert(2, pipeline.Stage('dedup', mark_duplicates, 1, config.EMBED_BATCH_SIZE, chunk_count))
+
+# with --bulk the vector index is dropped for the load, so inserts do not pay
+# for index maintenance, and rebuilt afterwards; searches fall back to a
+# sequential scan meanwhile. The index is also built after the first load.
+# On a partitioned perconavec only the partitions of the given sources are
+# re-indexed. Queue workers leave the index alone, run 05-reindex.py once
+# the queue is drained
+bulk = '--bulk' in sys.argv and not (enqueue or worker or show_jobs)
+if bulk:
+	indexes.drop_index(get_conn(), sources or None)
+
+if show_jobs:
+	if '--retry-failed' in sys.argv:
+		print('%d failed jobs queued again' % jobs.retry_failed(get_conn()))
+	counts, by_source = jobs.progress(get_conn())
+	print(' '.join('%s %d' % item for item in counts.items()))
+	for name, counts in by_source.items():
+		print('  %s: %s' % (name, ' '.join('%s %d' % item for item in counts.items())))
+elif enqueue:
+	queued = enqueue_jobs()
+	print('%d jobs queued, %d blog pages and %d docs files' % (len(queued), sum(1 for page in queued if page['kind'] == 'blog'), sum(1 for page in queued if page['kind'] == 'doc')))
+else:
+	# blog and docs (or jobs) count the pages their sources produce and the
+	# time spent waiting on the crawler and on git
+	stats.start()
+	if worker:
+		heartbeat = jobs.Heartbeat(get_conn, worker)
+		heartbeat.start()
+		source = stats.meter('jobs', job_pages())
+	else:
+		source = itertools.chain(stats.meter('blog', blog_pages()), stats.meter('docs', doc_pages()))
+	for page in pipeline.Pipeline(source, stages, metrics=stats).run():
+		print(page['url'])
+	if worker:
+		heartbeat.stop()
+
+	tables = [] if worker else indexes.indexed_tables(get_conn(), sources or None) if bulk else indexes.missing_indexes(get_conn())
+	for table in tables:
+		with stats.timed('index'):
+			indexes.build_table_index(get_conn(), table)
+
+	stats.stop()
+	stats.write_report()
+
+embedding.stop_cpu_pool()
+
+get_conn().close()
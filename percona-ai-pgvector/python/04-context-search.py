@@ -1,41 +1,15 @@
-from sentence_transformers import SentenceTransformer
-model = SentenceTransformer('WhereIsAI/UAE-Large-V1')
 from transformers import pipeline, AutoTokenizer, AutoConfig, AutoModelForQuestionAnswering
 import sys
-import config
+import search_client
 import torch
 
-def create_embedding(content):
-    embeddings = model.encode(content, device='cuda', show_progress_bar=True)
-    return(embeddings)
-
 text = [sys.argv[1]]
-embeddings = create_embedding(text)
-
-import psycopg2
-from pgvector.psycopg2 import register_vector
-conn = psycopg2.connect(
-    user=config.PGUSER,
-    password=config.PGPASSWORD,
-    database=config.PGDATABASE,
-    host=config.PGHOST,
-    port=config.PGPORT,
-)
-cur = conn.cursor()
-cur.execute("SET search_path TO " + 'test')
-register_vector(conn)
 
-cur.callproc('match_documents', (embeddings[0], 0.5, 50))
-
-row = cur.fetchone()
+# through the search service when it runs (09-search-service.py), see config.SEARCH_SERVICE
 documents = []
-while row is not None: 
+for row in search_client.search(text[0], 0.5, 50):
     print(row[3],row[2])
     documents.append(row[1])
-    row = cur.fetchone()
-
-cur.close()
-conn.close()
 
 def generate_response(context, query, model_name):
 
@@ -0,0 +1,25 @@
+# rebuild the vector index (config.INDEX_TYPE), ivfflat lists sized to the current rows with a vector
+# usage: python 05-reindex.py [ivfflat lists] [source ...]
+# sources pick the partitions to re-index when perconavec is partitioned
+import sys
+import psycopg2
+import config
+import indexes
+
+conn = psycopg2.connect(
+    user=config.PGUSER,
+    password=config.PGPASSWORD,
+    database=config.PGDATABASE,
+    host=config.PGHOST,
+    port=config.PGPORT,
+)
+cur = conn.cursor()
+cur.execute("SET search_path TO " + config.PGSCHEMA)
+conn.commit()
+
+args = sys.argv[1:]
+lists = int(args.pop(0)) if args and args[0].isdigit() else None
+indexes.build_index(conn, lists, args or None)
+
+cur.close()
+conn.close()
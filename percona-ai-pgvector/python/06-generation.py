@@ -0,0 +1,83 @@
+# blue/green re-embedding, see generations.py
+# usage: python 06-generation.py status
+#        python 06-generation.py build [--model name] [--chunk-tokens n] [--chunk-overlap n] [02-put.py arguments]
+#        python 06-generation.py swap | rollback | gc [--next]
+# build provisions <live>_next with 01-pg-provision.py unless it exists and
+# loads it with 02-put.py, so an interrupted build is resumed by running it
+# again and queue workers of the new generation run build --worker. The
+# settings given to build are recorded in its generation table; searches
+# follow the model of the live generation, ingestion needs them set in
+# config.py once the generation is swapped in. gc drops the previous
+# generation, or with --next an unfinished or rolled back one
+import argparse
+import contextlib
+import io
+import os
+import runpy
+import sys
+import config
+import generations
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(allow_abbrev=False)
+parser.add_argument('command', choices=['status', 'build', 'swap', 'rollback', 'gc'])
+parser.add_argument('--model', help='embedding model of the new generation, instead of config.EMBED_MODEL')
+parser.add_argument('--chunk-tokens', type=int, help='instead of config.CHUNK_TOKENS')
+parser.add_argument('--chunk-overlap', type=int, help='instead of config.CHUNK_OVERLAP_TOKENS')
+parser.add_argument('--next', action='store_true', help='gc drops <live>_next instead of <live>_old')
+args, put_args = parser.parse_known_args()
+
+if args.command == 'build':
+    if args.model:
+        config.EMBED_MODEL = args.model
+    if args.chunk_tokens:
+        config.CHUNK_TOKENS = args.chunk_tokens
+    if args.chunk_overlap is not None:
+        config.CHUNK_OVERLAP_TOKENS = args.chunk_overlap
+    # the model is checked against the vector columns before anything is
+    # provisioned; 02-put.py's cpu encode workers are forked for that here,
+    # before the connection opens
+    if not {'--enqueue', '--jobs'} & set(put_args):
+        import embedding
+        embedding.start_cpu_pool()
+        embedding.check_dimensions()
+
+conn = generations.connect()
+cur = conn.cursor()
+
+def print_generation(title, schema):
+    generation = generations.info(cur, schema)
+    if generation is None:
+        print('%-8s %s: none' % (title, schema))
+    else:
+        print('%-8s %s: %s' % (title, schema, ', '.join('%s %s' % item for item in generation.items())))
+
+if args.command == 'status':
+    print_generation('live', generations.live_schema())
+    print_generation('next', generations.next_schema())
+    print_generation('previous', generations.old_schema())
+elif args.command == 'build':
+    schema = generations.next_schema()
+    provision = not generations.schema_exists(cur, schema)
+    if provision:
+        cur.execute('CREATE SCHEMA %s' % schema)
+    conn.commit()
+    # tables go to the new schema, pgvector is still found in the live one
+    config.PGSCHEMA = '%s, %s' % (schema, config.PGSCHEMA)
+    if provision:
+        with contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path(os.path.join(HERE, '01-pg-provision.py'))
+    sys.argv = ['02-put.py'] + put_args
+    runpy.run_path(os.path.join(HERE, '02-put.py'))
+elif args.command == 'swap':
+    generations.swap(conn)
+    print_generation('live', generations.live_schema())
+elif args.command == 'rollback':
+    generations.rollback(conn)
+    print_generation('live', generations.live_schema())
+elif args.command == 'gc':
+    generations.drop(conn, generations.next_schema() if args.next else generations.old_schema())
+
+cur.close()
+conn.close()
@@ -0,0 +1,33 @@
+# export the ingested chunks and their embeddings to a snapshot directory,
+# see snapshot.py; 08-import.py loads it into another cluster
+# usage: python 07-export.py [--float16] directory
+# --float16 halves the size of the matrix, at the precision of a halfvec
+import sys
+import numpy as np
+import psycopg2
+from pgvector.psycopg2 import register_vector
+import config
+import snapshot
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+if len(args) != 1:
+    sys.exit('usage: python 07-export.py [--float16] directory')
+dtype = np.float16 if '--float16' in sys.argv else np.float32
+
+conn = psycopg2.connect(
+    user=config.PGUSER,
+    password=config.PGPASSWORD,
+    database=config.PGDATABASE,
+    host=config.PGHOST,
+    port=config.PGPORT,
+)
+cur = conn.cursor()
+cur.execute("SET search_path TO " + config.PGSCHEMA)
+conn.commit()
+register_vector(conn)
+
+meta = snapshot.export(conn, args[0], dtype)
+print('exported %d rows, %d with a %s vector, to %s' % (meta['rows'], meta['vectors'], meta['dtype'], args[0]))
+
+cur.close()
+conn.close()
@@ -0,0 +1,56 @@
+# load a snapshot directory written by 07-export.py, see snapshot.py
+# usage: python 08-import.py directory
+# the schema is provisioned with 01-pg-provision.py unless perconavec exists,
+# which has to be empty then. The vector index is dropped for the load and
+# built afterwards. Either layout (config.NORMALIZED_LAYOUT) loads a snapshot
+# of either one
+import contextlib
+import io
+import os
+import runpy
+import sys
+import psycopg2
+import config
+import indexes
+import snapshot
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+if len(sys.argv) != 2:
+    sys.exit('usage: python 08-import.py directory')
+snap = snapshot.Snapshot(sys.argv[1])
+
+conn = psycopg2.connect(
+    user=config.PGUSER,
+    password=config.PGPASSWORD,
+    database=config.PGDATABASE,
+    host=config.PGHOST,
+    port=config.PGPORT,
+)
+cur = conn.cursor()
+cur.execute("SET search_path TO " + config.PGSCHEMA)
+# in the first schema of config.PGSCHEMA, not one further down the search_path
+cur.execute("SELECT to_regclass(current_schema() || '.perconavec')")
+provision = cur.fetchone()[0] is None
+conn.commit()
+if provision:
+    with contextlib.redirect_stdout(io.StringIO()):
+        runpy.run_path(os.path.join(HERE, '01-pg-provision.py'))
+else:
+    cur.execute('SELECT 1 FROM perconavec LIMIT 1')
+    if cur.fetchone():
+        sys.exit('perconavec is not empty, import into a fresh schema')
+conn.commit()
+
+generation = snap.meta['generation']
+if generation and generation['embed_model'] != config.EMBED_MODEL:
+    print('warning: the snapshot was embedded with %s, config.EMBED_MODEL is %s' % (generation['embed_model'], config.EMBED_MODEL))
+
+indexes.drop_index(conn)
+snapshot.load(conn, snap)
+print('imported %d rows, %d with a vector' % (len(snap), snap.meta['vectors']))
+for table in indexes.indexed_tables(conn):
+    indexes.build_table_index(conn, table)
+
+cur.close()
+conn.close()
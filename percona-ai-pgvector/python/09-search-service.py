@@ -0,0 +1,7 @@
+# run the resident search service 03/04 send their queries to, see
+# search_service.py; it listens on config.SEARCH_SERVICE until interrupted
+# usage: python 09-search-service.py [host:port | socket path]
+import sys
+import search_service
+
+search_service.serve(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,78 @@
+# parity and latency of the search backends (config.SEARCH_BACKEND) against
+# the database: a full precision scan of perconavec, with the planner kept
+# off the ann index, is the ground truth for match_documents itself and for
+# the in-process backends over config.SEARCH_SNAPSHOT, which has to be an
+# export of the same data (07-export.py). Searches are unfiltered
+# usage: python bench-backends.py [queries] [k] [backend ...]
+# snapshot embeddings are used as queries, so no model is needed. Exits with
+# 1 when the exact backend does not return the database rows
+import sys
+import time
+import numpy as np
+import config
+import search
+import snapshot
+
+args = [arg for arg in sys.argv[1:] if not arg.isdigit()]
+numbers = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+queries = numbers[0] if numbers else 100
+k = numbers[1] if len(numbers) > 1 else 10
+names = args or ['postgres', 'exact', 'ivf']
+
+snap = snapshot.Snapshot(config.SEARCH_SNAPSHOT)
+if not snap.meta['vectors']:
+    sys.exit('no vectors in the snapshot %s' % config.SEARCH_SNAPSHOT)
+# float16 snapshots hold halfvec precision
+tolerance = {'float16': 1e-3}.get(snap.meta['dtype'], 1e-5)
+config.SEARCH_SOURCES = None
+
+database = search.open_backend('postgres')
+backends = {name: database if name == 'postgres' else search.open_backend(name) for name in names}
+rng = np.random.default_rng(0)
+vectors = [np.asarray(snap.embeddings[i], dtype=np.float32) for i in rng.choice(snap.meta['vectors'], min(queries, snap.meta['vectors']), replace=False)]
+
+# content and url per layout, from the tables the snapshot is exported from
+TEXT = {False: ('c.content', 'c.url'), True: ('t.content', 'd.url')}
+
+# the k nearest rows by the full precision embedding, like match_documents
+# returns them; with quantized storage match_documents picks its candidates
+# by the quantized column even without the index, so it is no ground truth
+def exact(vector):
+    content, url = TEXT[config.NORMALIZED_LAYOUT]
+    tables = snapshot.ROWS[config.NORMALIZED_LAYOUT][1]
+    with database.conn.cursor() as cur:
+        cur.execute('SET LOCAL enable_indexscan = off')
+        cur.execute('SELECT c.id, %s, %s, 1 - (c.embedding <=> %%s) FROM %s WHERE c.embedding <=> %%s < 2 ORDER BY c.embedding <=> %%s LIMIT %%s' % (content, url, tables),
+                    (vector, vector, vector, k))
+        rows = cur.fetchall()
+        urls = {row[0]: [row[2]] for row in rows}
+        if config.NEAR_DUP_DISTANCE is not None:
+            cur.execute('SELECT c.duplicate_of, %s FROM %s WHERE c.duplicate_of = ANY(%%s) ORDER BY c.id' % (url, tables), (list(urls),))
+            for parent, duplicate in cur:
+                urls[parent].append(duplicate)
+    database.conn.commit()
+    return [row + (urls[row[0]],) for row in rows]
+
+truths = [exact(vector) for vector in vectors]
+
+failed = False
+print('%-10s %8s %8s %12s %10s %10s' % ('backend', 'recall', 'min', 'similarity', 'mismatch', 'ms'))
+for name, backend in backends.items():
+    recalls, differences, mismatches, times = [], [0.0], 0, []
+    for vector, truth in zip(vectors, truths):
+        start = time.perf_counter()
+        rows = backend.search(vector, -1, k, None)
+        times.append(time.perf_counter() - start)
+        expected = {row[0]: row for row in truth}
+        recalls.append(len(set(expected) & set(row[0] for row in rows)) / max(1, len(expected)))
+        for id, content, url, similarity, urls in rows:
+            if id in expected:
+                differences.append(abs(similarity - expected[id][3]))
+                mismatches += (content, url, list(urls)) != (expected[id][1], expected[id][2], list(expected[id][4]))
+    print('%-10s %8.3f %8.3f %12.2e %10d %10.2f' % (name, np.mean(recalls), np.min(recalls), max(differences), mismatches, 1000 * np.mean(times)))
+    if name == 'exact' and (np.mean(recalls) < 0.99 or max(differences) > tolerance or mismatches):
+        failed = True
+
+for backend in backends.values():
+    backend.close()
+sys.exit(1 if failed else 0)
@@ -0,0 +1,68 @@
+# embedding throughput on this node and cosine drift of the cpu variants
+# against the fp32 model
+# usage: python bench-embedding.py [count] [file with one text per line]
+# without a file the texts are taken from the stored chunks
+import sys
+import time
+import numpy as np
+import config
+import embedding
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+def load_texts():
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            return [line.strip() for line in f if line.strip()][:count]
+    import psycopg2
+    import documents
+    conn = psycopg2.connect(
+        user=config.PGUSER,
+        password=config.PGPASSWORD,
+        database=config.PGDATABASE,
+        host=config.PGHOST,
+        port=config.PGPORT,
+    )
+    cur = conn.cursor()
+    cur.execute("SET search_path TO " + config.PGSCHEMA)
+    cur.execute('SELECT content FROM %s LIMIT %%s' % documents.TEXT_TABLE, (count,))
+    texts = [row[0] for row in cur]
+    conn.close()
+    return texts
+
+def timed(encode, texts):
+    encode(texts[:config.ENCODE_BATCH_SIZE])
+    start = time.perf_counter()
+    vectors = np.asarray(encode(texts))
+    return vectors, time.perf_counter() - start
+
+def normalized(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+texts = load_texts()
+results = []
+
+# process pools fork, so they run before any model is loaded here
+for quantize in (False, True):
+    if embedding.start_cpu_pool(quantize=quantize, device='cpu') is None:
+        break
+    name = '%s cpu x%d processes' % ('int8' if quantize else 'fp32', config.CPU_WORKERS)
+    results.append((name,) + timed(embedding.create_embeddings, texts))
+    embedding.stop_cpu_pool()
+
+device = embedding.pick_device()
+variants = [('fp32 %s' % device, device, False)]
+if device != 'cpu':
+    variants.append(('fp32 cpu', 'cpu', False))
+variants.append(('int8 cpu', 'cpu', True))
+for name, device, quantize in variants:
+    model = embedding.load_model(device, quantize)
+    encode = lambda texts: model.encode(texts, batch_size=config.ENCODE_BATCH_SIZE, show_progress_bar=False)
+    results.append((name,) + timed(encode, texts))
+
+reference = normalized(results[-len(variants)][1])
+print('%d texts, reference: %s' % (len(texts), results[-len(variants)][0]))
+print('%-28s %10s %12s %12s' % ('variant', 'texts/s', 'mean cosine', 'min cosine'))
+for name, vectors, seconds in results:
+    cosine = np.sum(normalized(vectors) * reference, axis=1)
+    print('%-28s %10.1f %12.6f %12.6f' % (name, len(texts) / seconds, cosine.mean(), cosine.min()))
@@ -0,0 +1,49 @@
+# blog html extractor throughput and equivalence on the saved pages in
+# fixtures/blog; bs4 is the reference output
+# usage: python bench-extract.py [rounds]
+#        python bench-extract.py --record url [url ...]  - save pages as fixtures
+import glob
+import os
+import sys
+import time
+import requests
+import extract
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'blog')
+
+def record(urls):
+    for url in urls:
+        name = url.rstrip('/').rsplit('/', 1)[-1] + '.html'
+        r = requests.get(url)
+        r.raise_for_status()
+        with open(os.path.join(FIXTURES, name), 'w', encoding='utf-8') as f:
+            f.write(r.text)
+        print('saved', name)
+
+if len(sys.argv) > 1 and sys.argv[1] == '--record':
+    record(sys.argv[2:])
+    sys.exit(0)
+
+rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+pages = {}
+for path in sorted(glob.glob(os.path.join(FIXTURES, '*.html'))):
+    with open(path, encoding='utf-8') as f:
+        pages[os.path.basename(path)] = f.read()
+
+reference = {name: extract.extract_bs4(html) for name, html in pages.items()}
+failed = False
+print('%d pages, %d rounds' % (len(pages), rounds))
+print('%-8s %10s %10s' % ('engine', 'pages/s', 'identical'))
+for engine, extractor in extract.EXTRACTORS.items():
+    different = [name for name, html in pages.items() if extractor(html) != reference[name]]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for html in pages.values():
+            extractor(html)
+    elapsed = time.perf_counter() - start
+    print('%-8s %10.1f %10s' % (engine, rounds * len(pages) / elapsed, '%d/%d' % (len(pages) - len(different), len(pages))))
+    for name in different:
+        print('  differs from bs4: %s' % name)
+    failed = failed or bool(different)
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,221 @@
+# offline ingestion benchmark: 02-put.py against a local copy of the inputs.
+# Blog pages and sitemaps built from fixtures/blog are served over http from
+# this process, docs repos built from fixtures/docs are cloned from local bare
+# repos (shallow clones need a smart git server, not plain http), chunks are
+# encoded by the deterministic stub model unless --model is given and rows
+# go to a scratch schema of the database in config.py. Every run is loaded
+# cold and then re-run with nothing changed. With --workers the pages go
+# through the ingest_jobs queue: 02-put.py --enqueue, then that many
+# 02-put.py --worker processes
+# usage: python bench-ingest.py [--pages 200] [--repos 4] [--files 30] [--workers n] [--model name] [--json path] [--keep]
+import argparse
+import contextlib
+import glob
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import re
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import psycopg2
+import config
+import docs_git
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMA = 'ingest_bench'
+LASTMOD = '2024-01-01T00:00:00+00:00'
+SITEMAP_SIZE = 100
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pages', type=int, default=200, help='blog pages')
+parser.add_argument('--repos', type=int, default=4, help='docs repos')
+parser.add_argument('--files', type=int, default=30, help='markdown files per repo')
+parser.add_argument('--workers', type=int, help='queue worker processes instead of a single 02-put.py run')
+parser.add_argument('--model', help='embedding model with config.EMBED_DIMENSIONS dimensions instead of the stub')
+parser.add_argument('--json', help='write both metrics reports to this file')
+parser.add_argument('--keep', action='store_true', help='keep the scratch schema and files')
+args = parser.parse_args()
+
+def read_fixtures(kind, pattern):
+    texts = {}
+    for path in sorted(glob.glob(os.path.join(HERE, 'fixtures', kind, pattern))):
+        with open(path, encoding='utf-8') as f:
+            texts[os.path.splitext(os.path.basename(path))[0]] = f.read()
+    return list(texts.items())
+
+# every copy of a fixture gets its own text, or the embedding cache would
+# serve all chunks but those of the first copy
+def blog_copy(html, n):
+    return re.sub(r'>(\s*)([^<\s][^<]*)<', lambda m: '>%s%d %s<' % (m.group(1), n, m.group(2)), html)
+
+def doc_copy(text, n):
+    return re.sub(r'(?m)(\S)$', r'\1 [%s]' % n, text)
+
+def build_blog(site, base, count):
+    blog = os.path.join(site, 'blog')
+    os.makedirs(blog)
+    fixtures = read_fixtures('blog', '*.html')
+    urls = []
+    for n in range(count):
+        slug, html = fixtures[n % len(fixtures)]
+        name = '%s-%d.html' % (slug, n)
+        with open(os.path.join(blog, name), 'w', encoding='utf-8') as f:
+            f.write(blog_copy(html, n))
+        urls.append('%s/blog/%s' % (base, name))
+    sitemaps = []
+    for i in range(0, len(urls), SITEMAP_SIZE):
+        name = 'post-sitemap%d.xml' % (i // SITEMAP_SIZE)
+        entries = ''.join('<url><loc>%s</loc><lastmod>%s</lastmod></url>' % (url, LASTMOD) for url in urls[i:i + SITEMAP_SIZE])
+        with open(os.path.join(blog, name), 'w') as f:
+            f.write('<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % entries)
+        sitemaps.append('%s/blog/%s' % (base, name))
+    with open(os.path.join(blog, 'sitemap_index.xml'), 'w') as f:
+        entries = ''.join('<sitemap><loc>%s</loc></sitemap>' % loc for loc in sitemaps)
+        f.write('<?xml version="1.0"?><sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</sitemapindex>' % entries)
+
+def build_repos(root, repos, files):
+    fixtures = read_fixtures('docs', '*.md')
+    docs = []
+    for r in range(repos):
+        doc = {'repo': 'bench/docs-%d' % r, 'branch': 'main'}
+        work = os.path.join(root, 'work', doc['repo'])
+        os.makedirs(os.path.join(work, 'docs'))
+        for n in range(files):
+            name, text = fixtures[n % len(fixtures)]
+            with open(os.path.join(work, 'docs', '%s-%d.md' % (name, n)), 'w', encoding='utf-8') as f:
+                f.write(doc_copy(text, '%d.%d' % (r, n)))
+        docs_git.git(work, 'init', '--quiet', '--initial-branch', doc['branch'])
+        docs_git.git(work, 'add', '.')
+        docs_git.git(work, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '--quiet', '-m', 'fixtures')
+        docs_git.git(None, 'clone', '--quiet', '--bare', work, os.path.join(root, 'repos', doc['repo'] + '.git'))
+        docs.append(doc)
+    return docs
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def scratch_schema(drop_only=False):
+    conn = psycopg2.connect(
+        user=config.PGUSER,
+        password=config.PGPASSWORD,
+        database=config.PGDATABASE,
+        host=config.PGHOST,
+        port=config.PGPORT,
+    )
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS %s CASCADE' % SCHEMA)
+        if not drop_only:
+            cur.execute('CREATE SCHEMA %s' % SCHEMA)
+    conn.commit()
+    conn.close()
+
+# 02-put.py output (one line per page) is dropped, progress lines on stderr
+# are kept
+def run_put(*argv):
+    sys.argv = ['02-put.py'] + list(argv)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return runpy.run_path(os.path.join(HERE, '02-put.py'))['stats']
+
+def queue_worker(reports):
+    reports.put(run_put('--worker').report())
+
+# counters of all workers added up, over the wall clock time of the run
+def merge_reports(reports, seconds):
+    stats, queues = {}, {}
+    for report in reports:
+        for name, stat in report['stats'].items():
+            merged = stats.setdefault(name, {})
+            for key, value in stat.items():
+                merged[key] = max(merged.get(key, 0), value) if key == 'max_seconds' else merged.get(key, 0) + value
+        for name, q in report['queues'].items():
+            merged = queues.setdefault(name, {'maxsize': q['maxsize'], 'mean_depth': 0, 'max_depth': 0})
+            merged['mean_depth'] += q['mean_depth'] / len(reports)
+            merged['max_depth'] = max(merged['max_depth'], q['max_depth'])
+    return {'seconds': seconds, 'stats': stats, 'queues': queues, 'workers': len(reports)}
+
+# config changes made here are inherited by the forked workers
+def ingest():
+    if not args.workers:
+        return run_put().report()
+    start = time.perf_counter()
+    run_put('--enqueue')
+    context = multiprocessing.get_context('fork')
+    reports = context.Queue()
+    workers = [context.Process(target=queue_worker, args=(reports,)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    results = [reports.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return merge_reports(results, time.perf_counter() - start)
+
+def print_report(title, report):
+    seconds = report['seconds']
+    stats = report['stats']
+    print('%s: %.2fs, %.1f pages/s, %.1f chunks/s, %.1f rows/s' % (
+        title, seconds,
+        stats.get('write', {}).get('items_out', 0) / seconds,
+        stats.get('embed', {}).get('chunks', 0) / seconds,
+        stats.get('write.copy', {}).get('rows', 0) / seconds))
+    print('  %-14s %8s %9s %8s %11s %10s %9s %8s' % ('stage', 'items', 'items/s', 'busy s', 'items/busy', 'chunks/s', 'rows/s', 'MB/s'))
+    for name, stat in stats.items():
+        count = stat.get('items_out', stat.get('calls', 0))
+        busy = stat.get('seconds', 0)
+        print('  %-14s %8d %9.1f %8.2f %11.1f %10s %9s %8s' % (
+            name, count, count / seconds, busy, count / busy if busy else 0,
+            '%.1f' % (stat['chunks'] / seconds) if 'chunks' in stat else '',
+            '%.1f' % (stat['rows'] / seconds) if 'rows' in stat else '',
+            '%.2f' % (stat['bytes'] / seconds / 2**20) if 'bytes' in stat else ''))
+    for name, q in report['queues'].items():
+        print('  queue %-8s mean %5.1f max %3d of %d' % (name, q['mean_depth'], q['max_depth'], q['maxsize']))
+
+root = tempfile.mkdtemp(prefix='bench-ingest-')
+site = os.path.join(root, 'site')
+os.makedirs(site)
+server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), lambda *a: QuietHandler(*a, directory=site))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = 'http://127.0.0.1:%d' % server.server_address[1]
+build_blog(site, base, args.pages)
+docs = build_repos(root, args.repos, args.files)
+
+config.BLOG_SITEMAP_URL = base + '/blog/sitemap_index.xml'
+config.BLOG_URL_PREFIX = base + '/blog/'
+config.DOCS = docs
+config.DOCS_GIT_URL = 'file://' + os.path.join(root, 'repos', '%s.git')
+config.DOCS_CLONE_DIR = os.path.join(root, 'clones')
+# tables go to the scratch schema, pgvector is still found in the configured one
+config.PGSCHEMA = '%s, %s' % (SCHEMA, config.PGSCHEMA)
+config.METRICS_REPORT = None
+config.EMBED_MODEL = args.model or 'stub'
+if not args.model:
+    # the stub has nothing to gain from encode processes
+    config.CPU_WORKERS = 1
+# workers waiting on each other's last jobs
+config.JOB_POLL_INTERVAL = 0.5
+
+print('%d blog pages, %d docs repos x %d files, model %s%s' % (args.pages, args.repos, args.files, config.EMBED_MODEL, ', %d queue workers' % args.workers if args.workers else ''))
+scratch_schema()
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        runpy.run_path(os.path.join(HERE, '01-pg-provision.py'))
+    reports = {'cold': ingest(), 'rerun, nothing changed': ingest()}
+finally:
+    server.shutdown()
+    if not args.keep:
+        scratch_schema(drop_only=True)
+        shutil.rmtree(root)
+
+for title, report in reports.items():
+    print_report(title, report)
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(dict(reports, pages=args.pages, repos=args.repos, files=args.files, workers=args.workers, model=config.EMBED_MODEL), f, indent=2)
+if args.keep:
+    print('kept schema %s and %s' % (SCHEMA, root))
@@ -0,0 +1,82 @@
+# recall@k and latency of match_documents against an exact scan, and the
+# size of the vector data behind it (see config.QUANTIZED_STORAGE)
+# usage: python bench-recall.py [queries] [k] [probes] [ef_search]
+# stored embeddings are used as queries, so no model is needed
+import sys
+import time
+import numpy as np
+import psycopg2
+from pgvector.psycopg2 import register_vector
+import config
+import indexes
+
+queries = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+probes = int(sys.argv[3]) if len(sys.argv) > 3 else config.SEARCH_PROBES
+ef_search = int(sys.argv[4]) if len(sys.argv) > 4 else config.SEARCH_EF_SEARCH
+
+conn = psycopg2.connect(
+    user=config.PGUSER,
+    password=config.PGPASSWORD,
+    database=config.PGDATABASE,
+    host=config.PGHOST,
+    port=config.PGPORT,
+)
+cur = conn.cursor()
+cur.execute("SET search_path TO " + config.PGSCHEMA)
+register_vector(conn)
+
+cur.execute('SELECT embedding FROM perconavec WHERE embedding IS NOT NULL ORDER BY random() LIMIT %s', (queries,))
+vectors = [row[0] for row in cur.fetchall()]
+conn.commit()
+if not vectors:
+    sys.exit('perconavec is empty')
+
+# the planner is kept off the ann index for the ground truth
+def exact(vector):
+    cur.execute('SET LOCAL enable_indexscan = off')
+    cur.execute('SELECT id FROM perconavec WHERE embedding IS NOT NULL ORDER BY embedding <=> %s LIMIT %s', (vector, k))
+    ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return ids
+
+def approximate(vector):
+    cur.callproc('match_documents', (vector, -1, k, probes, ef_search))
+    ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return ids
+
+def timed(search, vector):
+    start = time.perf_counter()
+    ids = search(vector)
+    return ids, time.perf_counter() - start
+
+recalls, exact_times, ann_times = [], [], []
+for vector in vectors:
+    truth, exact_time = timed(exact, vector)
+    found, ann_time = timed(approximate, vector)
+    recalls.append(len(set(truth) & set(found)) / max(1, len(truth)))
+    exact_times.append(exact_time)
+    ann_times.append(ann_time)
+
+print('storage: %s, index: %s, probes: %s, ef_search: %s, rerank_factor: %s' % (
+    config.QUANTIZED_STORAGE or 'vector', config.INDEX_TYPE, probes, ef_search, config.RERANK_FACTOR))
+print('recall@%d over %d queries: mean %.3f, min %.3f' % (k, len(recalls), np.mean(recalls), np.min(recalls)))
+print('latency ms: exact %.2f, match_documents %.2f' % (1000 * np.mean(exact_times), 1000 * np.mean(ann_times)))
+
+cur.execute('SELECT pg_table_size(%s), pg_indexes_size(%s)', ('perconavec', 'perconavec'))
+print('table: %d MB, indexes: %d MB' % tuple(size // 2**20 for size in cur.fetchone()))
+if config.NORMALIZED_LAYOUT:
+    for table in ['documents', 'chunk_texts']:
+        cur.execute('SELECT pg_table_size(%s), pg_indexes_size(%s)', (table, table))
+        print('%s: %d MB, indexes: %d MB' % ((table,) + tuple(size // 2**20 for size in cur.fetchone())))
+if indexes.has_index(conn):
+    cur.execute('SELECT pg_relation_size(%s)', (indexes.qualified(conn, indexes.INDEX),))
+    print('vector index: %d MB' % (cur.fetchone()[0] // 2**20))
+cur.execute("SELECT attname FROM pg_attribute WHERE attrelid = 'perconavec'::regclass AND attname IN ('embedding', 'embedding_q')")
+for (column,) in cur.fetchall():
+    cur.execute('SELECT avg(pg_column_size(%s)) FROM perconavec' % column)
+    print('%s: %d bytes per row' % (column, cur.fetchone()[0] or 0))
+
+cur.close()
+conn.close()
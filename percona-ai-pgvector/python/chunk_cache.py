@@ -0,0 +1,71 @@
+# content-addressed chunks: embeddings are reused by the hash of the
+# normalized chunk text and pages are updated chunk by chunk
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import config
+
+# ids and hashes of the rows stored for a url
+PAGE_ROWS = {
+    False: 'SELECT id, content_hash FROM perconavec WHERE url = %s AND source = %s',
+    True: 'SELECT c.id, c.content_hash FROM perconavec c JOIN documents d ON d.id = c.doc_id WHERE d.url = %s AND c.source = %s',
+}[config.NORMALIZED_LAYOUT]
+
+def normalize(text):
+    return ' '.join(text.split())
+
+def chunk_hash(text):
+    return hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()
+
+def as_array(value):
+    if hasattr(value, 'to_numpy'):
+        return value.to_numpy()
+    return np.asarray(value, dtype=np.float32)
+
+# looks hashes up in a local LRU first and in perconavec second
+class EmbeddingCache:
+    def __init__(self, conn, size=config.EMBED_CACHE_SIZE):
+        self.conn = conn
+        self.size = size
+        self.local = OrderedDict()
+
+    def add(self, content_hash, vector):
+        self.local[content_hash] = vector
+        self.local.move_to_end(content_hash)
+        if len(self.local) > self.size:
+            self.local.popitem(last=False)
+
+    def lookup(self, hashes):
+        found = {}
+        missing = []
+        for h in set(hashes):
+            if h in self.local:
+                self.local.move_to_end(h)
+                found[h] = self.local[h]
+            else:
+                missing.append(h)
+        if missing:
+            with self.conn.cursor() as cur:
+                cur.execute('SELECT DISTINCT ON (content_hash) content_hash, embedding FROM perconavec WHERE content_hash = ANY(%s) AND embedding IS NOT NULL', (missing,))
+                for h, vector in cur:
+                    found[h] = as_array(vector)
+                    self.add(h, found[h])
+        return found
+
+# compares the chunks of a page with the rows stored for its url and returns
+# the chunks that are not stored yet and the ids of rows whose text is gone
+# (or repeated), for the writer to insert and delete. chunk_no is the position
+# of a chunk among the distinct chunks of the page
+def diff_chunks(cur, url, source, texts):
+    chunks = {}
+    for text in texts:
+        chunks.setdefault(chunk_hash(text), text)
+    cur.execute(PAGE_ROWS, (url, source))
+    stale = []
+    kept = set()
+    for id, h in cur.fetchall():
+        if h in chunks and h not in kept:
+            kept.add(h)
+        else:
+            stale.append(id)
+    return [{'url': url, 'source': source, 'content': text, 'content_hash': h, 'chunk_no': n} for n, (h, text) in enumerate(chunks.items()) if h not in kept], stale
@@ -0,0 +1,31 @@
+# token-aware chunking: chunk size and overlap are counted in tokens of the
+# embedding model's tokenizer, so chunks fill the model window instead of a
+# fixed number of characters
+import threading
+from langchain.text_splitter import MarkdownTextSplitter, RecursiveCharacterTextSplitter
+import config
+
+# fast tokenizers must not be shared between threads
+local = threading.local()
+
+def get_tokenizer():
+    if not hasattr(local, 'tokenizer'):
+        from transformers import AutoTokenizer
+        local.tokenizer = AutoTokenizer.from_pretrained(config.EMBED_MODEL)
+    return local.tokenizer
+
+# special tokens the model adds around every chunk are not counted; the stub
+# model of the benchmarks has no tokenizer, words stand in for tokens
+def count_tokens(text):
+    if config.EMBED_MODEL == 'stub':
+        return len(text.split())
+    return len(get_tokenizer().tokenize(text))
+
+blog_splitter = RecursiveCharacterTextSplitter(chunk_size=config.CHUNK_TOKENS, chunk_overlap=config.CHUNK_OVERLAP_TOKENS, length_function=count_tokens)
+doc_splitter = MarkdownTextSplitter(chunk_size=config.CHUNK_TOKENS, chunk_overlap=config.CHUNK_OVERLAP_TOKENS, length_function=count_tokens)
+
+def blog_chunks(text):
+    return blog_splitter.create_documents([text])
+
+def doc_chunks(text):
+    return doc_splitter.create_documents([text])
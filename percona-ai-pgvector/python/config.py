@@ -3,3 +3,151 @@ PGPASSWORD=''
 PGUSER='vector'
 PGDATABASE='vector-db'
 PGPORT=5432
+# search_path of every connection, tables are created in its first schema
+PGSCHEMA='test'
+
+# embeddings
+EMBED_MODEL='WhereIsAI/UAE-Large-V1'
+# dimensions of the vector columns, the model has to embed in as many
+EMBED_DIMENSIONS=1024
+# chunks collected from many pages and passed to a single encode() call
+EMBED_BATCH_SIZE=512
+# forward pass batch size inside encode()
+ENCODE_BATCH_SIZE=64
+# 'auto' picks cuda, then mps, then cpu
+EMBED_DEVICE='auto'
+# cpu only: worker processes sharing each encode batch, and int8 dynamic quantization
+CPU_WORKERS=4
+EMBED_QUANTIZE=False
+# chunk size and overlap in model tokens; the size plus the model's special
+# tokens has to fit its window (512 for UAE-Large-V1)
+CHUNK_TOKENS=500
+CHUNK_OVERLAP_TOKENS=50
+# chunks whose simhash is at most this many bits from a stored chunk are kept
+# as duplicates without a vector, see dedup.py; None turns it off, values
+# above 3 can miss matches. Only within a source with PARTITION_BY_SOURCE.
+# Read by 01-pg-provision.py as well
+NEAR_DUP_DISTANCE=3
+# rows per COPY into perconavec, one commit per batch
+COPY_BATCH_SIZE=2000
+
+# blog crawler
+BLOG_SITEMAP_URL='https://www.percona.com/blog/sitemap_index.xml'
+BLOG_URL_PREFIX='https://www.percona.com/blog/'
+CRAWL_CONCURRENCY=16
+CRAWL_TIMEOUT=60
+CRAWL_KEEPALIVE=30
+# bytes read from a sitemap response at a time by the streaming parser
+SITEMAP_READ_SIZE=65536
+# embeddings kept in memory by content hash, looked up in perconavec on a miss
+EMBED_CACHE_SIZE=20000
+
+# ingestion pipeline: worker threads per stage and items per queue between stages
+FETCH_WORKERS=8
+PARSE_WORKERS=4
+EMBED_WORKERS=1
+WRITE_WORKERS=1
+PIPELINE_QUEUE_SIZE=64
+# seconds a partial batch waits for more items before it is passed on
+PIPELINE_FLUSH_INTERVAL=1
+
+# ingest_jobs work queue for 02-put.py --enqueue / --worker, see jobs.py:
+# jobs claimed at a time, seconds a claim is leased for (extended while the
+# worker runs), attempts before a job is failed, seconds between retries
+# (times the attempts so far) and between polls of a drained queue
+JOB_CLAIM_SIZE=16
+JOB_LEASE=300
+JOB_MAX_ATTEMPTS=3
+JOB_RETRY_DELAY=60
+JOB_POLL_INTERVAL=5
+# ingestion metrics: seconds between progress lines on stderr (None for
+# none), the json report written after a run (None for none), and a stage to
+# cProfile, dumped to PROFILE_PATH % stage
+METRICS_INTERVAL=10
+METRICS_REPORT='ingest-report.json'
+PROFILE_STAGE=None
+PROFILE_PATH='ingest-%s.prof'
+
+# docs repos and branches ingested next to the blog
+DOCS=[
+    {'repo': 'percona-platform/portal-doc', 'branch': 'main'},
+    {'repo': 'percona/pmm-doc', 'branch': 'main'},
+    {'repo': 'percona/pdmysql-docs', 'branch': 'innovation-release'},
+    {'repo': 'percona/pxc-docs', 'branch': '8.0'},
+    {'repo': 'percona/pxb-docs', 'branch': 'innovation-release'},
+    {'repo': 'percona/proxysql-admin-tool-doc', 'branch': 'main'},
+    {'repo': 'percona/distmongo-docs', 'branch': '7.0'},
+    {'repo': 'percona/psmdb-docs', 'branch': '7.0'},
+    {'repo': 'percona/pbm-docs', 'branch': 'main'},
+    {'repo': 'percona/postgresql-docs', 'branch': '16'},
+    {'repo': 'percona/k8sps-docs', 'branch': 'main'},
+    {'repo': 'percona/k8spsmdb-docs', 'branch': 'main'},
+    {'repo': 'percona/k8spxc-docs', 'branch': 'main'},
+    {'repo': 'percona/k8spg-docs', 'branch': 'main'},
+    {'repo': 'percona/everest-doc', 'branch': 'main'},
+    {'repo': 'percona/psmysql-docs', 'branch': 'innovation-release'}
+]
+# docs are read from shallow clones of DOCS_GIT_URL % repo kept under DOCS_CLONE_DIR
+DOCS_GIT_URL='https://github.com/%s.git'
+DOCS_CLONE_DIR='~/.cache/percona-ai-pgvector/docs'
+# blog html extractor, see extract.EXTRACTORS
+HTML_EXTRACTOR='lxml'
+
+# vector index: 'ivfflat' or 'hnsw'
+INDEX_TYPE='ivfflat'
+HNSW_M=16
+HNSW_EF_CONSTRUCTION=64
+# None, or 'halfvec' / 'binary' (pgvector 0.7+): a quantized embedding_q column
+# carries the ann index and match_documents re-ranks RERANK_FACTOR * match_count
+# candidates with the full precision vectors
+QUANTIZED_STORAGE=None
+RERANK_FACTOR=4
+# list partition perconavec by source ('blog' or a docs repo), one vector
+# index per partition; read by 01-pg-provision.py. This excludes near
+# duplicates across sources (NEAR_DUP_DISTANCE): they are then only looked
+# for within a source, and every docs repo is its own source, so copies of a
+# page in several repos (the operator docs, the MySQL docs) keep a vector each
+PARTITION_BY_SOURCE=False
+# normalized layout, see documents.py: urls and metadata in documents, chunk
+# text in chunk_texts, stored compressed (None for the server default; lz4
+# needs PostgreSQL 14+ built with it, else the default is kept) and out of
+# line from toast_tuple_target bytes on;
+# read by 01-pg-provision.py and every script that writes or reads chunks
+NORMALIZED_LAYOUT=False
+CHUNK_TEXT_COMPRESSION='lz4'
+CHUNK_TEXT_TOAST_TARGET=128
+# vector index builds
+INDEX_MAINTENANCE_WORK_MEM='2GB'
+INDEX_PARALLEL_WORKERS=4
+
+# 06-generation.py swap: how long searches may wait for its locks, and how
+# often it tries before giving up
+SWAP_LOCK_TIMEOUT='2s'
+SWAP_ATTEMPTS=30
+
+# per-query search knobs passed to match_documents, None keeps the server default
+SEARCH_PROBES=None
+SEARCH_EF_SEARCH=None
+# None, or a list of sources ('blog', 'percona/psmdb-docs', ...) searches are limited to
+SEARCH_SOURCES=None
+# metadata filters, see search.FILTERS, e.g. {'repos': ['percona/psmdb-docs'], 'published_after': '2023-01-01'};
+# when set searches go through match_documents_filtered
+SEARCH_FILTERS=None
+# None, or 'relaxed_order' / 'strict_order' (pgvector 0.8+): filtered index
+# scans continue until enough rows pass the filters
+SEARCH_ITERATIVE_SCAN=None
+# where 03/04 search: 'postgres' (match_documents), or in process without a
+# database over the snapshot directory SEARCH_SNAPSHOT written by 07-export.py:
+# 'exact' scans every vector, 'ivf' the SEARCH_PROBES lists (1 when None)
+# closest to the query, out of LOCAL_IVF_LISTS (None: sized like the ivfflat
+# index) trained in process, see local_search.py
+SEARCH_BACKEND='postgres'
+SEARCH_SNAPSHOT='snapshot'
+LOCAL_IVF_LISTS=None
+# the search service (09-search-service.py) 03/04 send their queries to:
+# 'host:port' or the path of a unix socket. Without one (None, or nothing
+# listening) they load the model and search in process. The service runs
+# up to SEARCH_SERVICE_BACKENDS searches at a time, each on its own connection
+SEARCH_SERVICE='127.0.0.1:8642'
+SEARCH_SERVICE_BACKENDS=4
+SEARCH_SERVICE_TIMEOUT=30
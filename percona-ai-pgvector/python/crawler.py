@@ -0,0 +1,168 @@
+# concurrent sitemap and page crawler on a pooled keep-alive HTTP client
+import asyncio
+import queue
+import threading
+from xml.etree.ElementTree import XMLPullParser
+import aiohttp
+import config
+
+def new_session(concurrency=config.CRAWL_CONCURRENCY):
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=config.CRAWL_KEEPALIVE)
+    timeout = aiohttp.ClientTimeout(total=config.CRAWL_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+# conditional GET, page['html'] is left as None when the server answers 304
+async def fetch_page(session, page, known):
+    headers = {}
+    if known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known.get('last_modified'):
+        headers['If-Modified-Since'] = known['last_modified']
+    async with session.get(page['url'], headers=headers) as r:
+        if r.status == 304:
+            page['etag'] = known.get('etag')
+            page['last_modified'] = known.get('last_modified')
+            return page
+        r.raise_for_status()
+        page['etag'] = r.headers.get('ETag')
+        page['last_modified'] = r.headers.get('Last-Modified')
+        # invalid bytes are replaced, as requests does, instead of failing the page
+        page['html'] = await r.text(errors='replace')
+        return page
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+# (loc, lastmod) of the <url> or <sitemap> entries completed so far; an entry
+# is dropped from the tree once read, so the parser holds only the current one
+def sitemap_entries(parser, root):
+    for event, elem in parser.read_events():
+        if event == 'start':
+            if not root:
+                root.append(elem)
+            continue
+        if local_name(elem.tag) not in ('url', 'sitemap'):
+            continue
+        fields = {local_name(child.tag): (child.text or '').strip() for child in elem}
+        root[0].clear()
+        if fields.get('loc'):
+            yield fields['loc'], fields.get('lastmod') or None
+
+# entries of a sitemap or sitemap index, parsed while the body streams in
+async def stream_sitemap(session, url):
+    parser = XMLPullParser(events=('start', 'end'))
+    root = []
+    async with session.get(url) as r:
+        r.raise_for_status()
+        async for data in r.content.iter_chunked(config.SITEMAP_READ_SIZE):
+            parser.feed(data)
+            for entry in sitemap_entries(parser, root):
+                yield entry
+    parser.close()
+    for entry in sitemap_entries(parser, root):
+        yield entry
+
+# child sitemaps are streamed one after the other, pages are yielded in
+# sitemap order as soon as their entry is parsed
+async def sitemap_pages(session, index_url, prefix):
+    sitemaps = [loc async for loc, lastmod in stream_sitemap(session, index_url)]
+    for sitemap in sitemaps:
+        async for loc, lastmod in stream_sitemap(session, sitemap):
+            if loc.startswith(prefix):
+                yield {'url': loc, 'lastmod': lastmod, 'html': None}
+
+# fetches pages with at most `concurrency` requests in flight and yields them
+# as they complete; failed pages are reported and skipped. known maps url to
+# its ingest_state row: pages whose sitemap lastmod did not move are skipped,
+# the rest are fetched with If-None-Match/If-Modified-Since
+async def crawl_pages(session, pages, known, concurrency=config.CRAWL_CONCURRENCY):
+    todo = asyncio.Queue(maxsize=concurrency)
+    done = asyncio.Queue(maxsize=concurrency)
+
+    async def feed():
+        try:
+            async for page in pages:
+                state = known.get(page['url'], {})
+                if page['lastmod'] and page['lastmod'] == state.get('lastmod'):
+                    continue
+                await todo.put((page, state))
+        finally:
+            for _ in range(concurrency):
+                await todo.put(None)
+
+    # any error of a page is its own, the worker goes on with the next one;
+    # a worker that ends anyway still tells the consumer
+    async def work():
+        try:
+            while (item := await todo.get()) is not None:
+                page, state = item
+                try:
+                    page = await fetch_page(session, page, state)
+                except Exception as e:
+                    print('failed to fetch %s: %s: %s' % (page['url'], type(e).__name__, e))
+                    continue
+                await done.put(page)
+        finally:
+            await done.put(None)
+
+    tasks = [asyncio.create_task(feed())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        running = concurrency
+        while running:
+            page = await done.get()
+            if page is None:
+                running -= 1
+            else:
+                yield page
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# page dicts of the sitemaps, nothing fetched
+async def list_sitemaps(index_url, prefix):
+    async with new_session() as session:
+        return [page async for page in sitemap_pages(session, index_url, prefix)]
+
+def sitemap_list(index_url=config.BLOG_SITEMAP_URL, prefix=config.BLOG_URL_PREFIX):
+    return asyncio.run(list_sitemaps(index_url, prefix))
+
+# every page comes back, a failed one, whatever the error, with page['error']
+# set
+async def fetch_all(pages, known, concurrency):
+    async with new_session(concurrency) as session:
+        async def fetch(page):
+            try:
+                return await fetch_page(session, page, known.get(page['url'], {}))
+            except Exception as e:
+                page['error'] = '%s: %s' % (type(e).__name__, e)
+                return page
+        return await asyncio.gather(*(fetch(page) for page in pages))
+
+# conditional GETs of a list of pages, e.g. claimed jobs
+def fetch_pages(pages, known={}, concurrency=config.CRAWL_CONCURRENCY):
+    return asyncio.run(fetch_all(pages, known, concurrency))
+
+async def crawl_blog(out, known, index_url, prefix, concurrency):
+    async with new_session(concurrency) as session:
+        async for page in crawl_pages(session, sitemap_pages(session, index_url, prefix), known, concurrency):
+            await asyncio.get_running_loop().run_in_executor(None, out.put, page)
+
+def run_crawler(out, known, index_url, prefix, concurrency):
+    try:
+        asyncio.run(crawl_blog(out, known, index_url, prefix, concurrency))
+    except Exception as e:
+        out.put(e)
+    else:
+        out.put(None)
+
+# runs the crawler on its own event loop thread and yields page dicts
+# (url, lastmod, etag, last_modified, html) to synchronous code; the bounded
+# queue keeps the crawler from running ahead
+def blog_pages(known={}, index_url=config.BLOG_SITEMAP_URL, prefix=config.BLOG_URL_PREFIX, concurrency=config.CRAWL_CONCURRENCY):
+    out = queue.Queue(maxsize=concurrency * 2)
+    threading.Thread(target=run_crawler, args=(out, known, index_url, prefix, concurrency), daemon=True).start()
+    while (page := out.get()) is not None:
+        if isinstance(page, Exception):
+            raise page
+        yield page
@@ -0,0 +1,171 @@
+# near-duplicate chunks across pages, repos and branches: every new chunk gets
+# a 64 bit simhash of its word shingles. A chunk within
+# config.NEAR_DUP_DISTANCE bits of a canonical chunk is stored without a
+# vector and points at it with duplicate_of, so it is neither indexed nor
+# searched; searches return the canonical row with the urls of its duplicates
+import hashlib
+import threading
+import numpy as np
+import chunk_cache
+import config
+import documents
+
+SHINGLE = 3
+MASK = (1 << 64) - 1
+# 16 bit bands, tagged with their position: two simhashes at most 3 bits
+# apart share at least one band. Kept by the database in simhash_bands
+BANDS = 4
+BANDS_SQL = 'array[%s]' % ', '.join('(%d | ((simhash >> %d) & 65535))::int' % (i << 16, 16 * i) for i in range(BANDS))
+
+def simhash(text):
+    words = chunk_cache.normalize(text).lower().split()
+    shingles = [' '.join(words[i:i + SHINGLE]) for i in range(max(1, len(words) - SHINGLE + 1))]
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingles], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(shingles)
+    # as a signed value for the bigint column
+    return int(np.packbits(votes > 0, bitorder='little').view(np.int64)[0])
+
+def bands(value):
+    return [(i << 16) | (((value & MASK) >> (16 * i)) & 0xffff) for i in range(BANDS)]
+
+def distance(a, b):
+    return bin((a ^ b) & MASK).count('1')
+
+# runs as a single pipeline worker: canonical chunks found in the database or
+# assigned in this run are kept in memory, they may not be written yet. With
+# config.PARTITION_BY_SOURCE a chunk is only a duplicate of a chunk of its own
+# source, so searches limited to sources keep their partition pruning; copies
+# across docs repos, each a source of its own, are not found then
+class Deduper:
+    def __init__(self, conn, max_distance=config.NEAR_DUP_DISTANCE):
+        self.conn = conn
+        self.max_distance = max_distance
+        # band -> [(id, simhash, source)] of canonical chunks
+        self.canonical = {}
+        self.seen = set()
+        # rows the pages seen so far are about to delete
+        self.stale = set()
+
+    def add(self, id, value, source):
+        if id in self.seen:
+            return
+        self.seen.add(id)
+        for band in bands(value):
+            self.canonical.setdefault(band, []).append((id, value, source))
+
+    def load(self, values, sources):
+        query = 'SELECT id, simhash, source FROM perconavec WHERE duplicate_of IS NULL AND simhash_bands && %s'
+        args = [sorted(set(band for value in values for band in bands(value)))]
+        if config.PARTITION_BY_SOURCE:
+            query += ' AND source = ANY(%s)'
+            args.append(sorted(sources))
+        with self.conn.cursor() as cur:
+            cur.execute(query, args)
+            for id, value, source in cur.fetchall():
+                self.add(id, value, source)
+
+    def find(self, value, source):
+        best = None
+        for band in bands(value):
+            for id, other, other_source in self.canonical.get(band, []):
+                if config.PARTITION_BY_SOURCE and other_source != source:
+                    continue
+                d = distance(value, other)
+                if d <= self.max_distance and id not in self.stale and (best is None or d < best[0]):
+                    best = (d, id)
+        return best[1] if best else None
+
+    # new chunks get their row id here, so later chunks can point at them
+    def dedup(self, pages):
+        for page in pages:
+            self.stale.update(page['stale'])
+        chunks = [chunk for page in pages for chunk in page['chunks']]
+        if not chunks:
+            return pages
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT nextval(pg_get_serial_sequence('perconavec', 'id')) FROM generate_series(1, %s)", (len(chunks),))
+            ids = [row[0] for row in cur.fetchall()]
+        for chunk, id in zip(chunks, ids):
+            chunk['id'] = id
+            chunk['simhash'] = simhash(chunk['content'])
+        self.load([chunk['simhash'] for chunk in chunks], set(chunk['source'] for chunk in chunks))
+        self.conn.commit()
+        for chunk in chunks:
+            chunk['duplicate_of'] = self.find(chunk['simhash'], chunk['source'])
+            if chunk['duplicate_of'] is None:
+                self.add(chunk['id'], chunk['simhash'], chunk['source'])
+        return pages
+
+# canonical rows deleted in this run -> the row that took over (None when it
+# had no duplicates left), for duplicates written after the deletion
+replaced = {}
+replaced_lock = threading.Lock()
+
+# a deleted canonical row hands its vector to its oldest remaining duplicate,
+# a near duplicate so the vector still fits, and the others point at that
+# one from then on. The canonical rows are locked first: a writer that is
+# about to point new duplicates at one of them (attach) holds it FOR KEY
+# SHARE, so the heir is picked once those duplicates are committed
+def delete_rows(cur, ids):
+    cur.execute('SELECT id FROM perconavec WHERE id = ANY(%s) AND duplicate_of IS NULL ORDER BY id FOR UPDATE', (ids,))
+    canonical = [row[0] for row in cur.fetchall()]
+    heirs = dict.fromkeys(canonical)
+    if canonical:
+        cur.execute('SELECT duplicate_of, min(id) FROM perconavec WHERE duplicate_of = ANY(%s) AND NOT id = ANY(%s) GROUP BY duplicate_of', (canonical, ids))
+        for old, heir in cur.fetchall():
+            heirs[old] = heir
+            cur.execute('UPDATE perconavec SET embedding = (SELECT embedding FROM perconavec WHERE id = %s), duplicate_of = NULL WHERE id = %s', (old, heir))
+            cur.execute('UPDATE perconavec SET duplicate_of = %s WHERE duplicate_of = %s', (heir, old))
+    cur.execute('DELETE FROM perconavec WHERE id = ANY(%s)', (ids,))
+    if config.NORMALIZED_LAYOUT:
+        documents.delete_texts(cur, ids)
+    with replaced_lock:
+        replaced.update(heirs)
+
+# points chunks whose canonical row was deleted in this process at its heir
+# and returns those left without one; the first of them becomes the new
+# canonical row for the others and needs a vector of its own
+def reattach(chunks):
+    orphans = []
+    with replaced_lock:
+        for chunk in chunks:
+            old = chunk.get('duplicate_of')
+            while old in replaced and replaced[old] is not None and replaced[old] != old:
+                old = replaced[old]
+            if old not in replaced:
+                chunk['duplicate_of'] = old
+                continue
+            replaced[old] = chunk['id']
+            chunk['duplicate_of'] = None
+            orphans.append(chunk)
+    return orphans
+
+# reattach, then the canonical rows the chunks point at are checked in the
+# write transaction and locked FOR KEY SHARE until it commits. A row that is
+# gone was deleted by another process, or never written because a worker
+# lost the lease of its page; its duplicates are orphans like those of
+# reattach
+def attach(cur, chunks):
+    orphans = reattach(chunks)
+    written = set(chunk['id'] for chunk in chunks if chunk.get('duplicate_of') is None)
+    targets = sorted(set(chunk['duplicate_of'] for chunk in chunks if chunk.get('duplicate_of') is not None) - written)
+    found = set()
+    if targets:
+        cur.execute('SELECT id FROM perconavec WHERE id = ANY(%s) AND duplicate_of IS NULL ORDER BY id FOR KEY SHARE', (targets,))
+        found = set(row[0] for row in cur.fetchall())
+    heirs = {}
+    for chunk in chunks:
+        old = chunk.get('duplicate_of')
+        if old is None or old in written or old in found:
+            continue
+        if old in heirs:
+            chunk['duplicate_of'] = heirs[old]
+            continue
+        heirs[old] = chunk['id']
+        chunk['duplicate_of'] = None
+        written.add(chunk['id'])
+        orphans.append(chunk)
+    with replaced_lock:
+        replaced.update(heirs)
+    return orphans
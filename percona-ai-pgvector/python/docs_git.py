@@ -0,0 +1,96 @@
+# percona docs read from shallow local clones instead of the GitHub API
+import fcntl
+import os
+import re
+import subprocess
+from datetime import datetime
+import config
+
+MD_PATH = re.compile(r'docs/.*\.md')
+
+def git(cwd, *args):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+def clone_dir(doc):
+    return os.path.join(os.path.expanduser(config.DOCS_CLONE_DIR), doc['repo'], doc['branch'])
+
+# one shallow clone per repo/branch; later runs fetch only the new head. The
+# previous head stays in the object store, so it can still be diffed against.
+# A lock file keeps ingestion processes on one host from updating a clone at
+# the same time
+def update_clone(doc):
+    path = clone_dir(doc)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(os.path.join(path, '.git')):
+            git(None, 'clone', '--quiet', '--depth', '1', '--single-branch', '--branch', doc['branch'], config.DOCS_GIT_URL % doc['repo'], path)
+        else:
+            git(path, 'fetch', '--quiet', '--depth', '1', 'origin', doc['branch'])
+            git(path, 'reset', '--quiet', '--hard', 'FETCH_HEAD')
+    return path
+
+def head_commit(path):
+    return git(path, 'rev-parse', 'HEAD').strip()
+
+def commit_time(path):
+    return datetime.fromisoformat(git(path, 'log', '-1', '--format=%cI', 'HEAD').strip())
+
+def md_files(path):
+    return [name for name in git(path, 'ls-tree', '-r', '--name-only', 'HEAD').splitlines() if MD_PATH.search(name)]
+
+def has_commit(path, commit):
+    try:
+        git(path, 'cat-file', '-e', commit + '^{commit}')
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+def file_url(doc, name):
+    return 'https://raw.githubusercontent.com/%s/%s/%s' % (doc['repo'], doc['branch'], name)
+
+# files of a repo/branch that have rows, from their urls
+def stored_files(conn, doc):
+    prefix = file_url(doc, '')
+    with conn.cursor() as cur:
+        cur.execute('SELECT DISTINCT url FROM %s WHERE repo = %%s AND branch = %%s' % ('documents' if config.NORMALIZED_LAYOUT else 'perconavec'),
+                    (doc['repo'], doc['branch']))
+        return [url[len(prefix):] for url, in cur if url.startswith(prefix)]
+
+# markdown files changed and deleted between commit `since` and HEAD; every
+# file counts as changed when there is no usable previous commit (a restored
+# docs_state, a wiped clone), and the stored files no longer in the clone
+# count as deleted; stored() lists them
+def changed_files(path, since, stored):
+    if since is None or not has_commit(path, since):
+        files = md_files(path)
+        present = set(files)
+        return files, sorted(name for name in set(stored()) if name not in present)
+    changed, deleted = [], []
+    for line in git(path, 'diff', '--name-status', '--no-renames', since, 'HEAD').splitlines():
+        status, name = line.split('\t', 1)
+        if not MD_PATH.search(name):
+            continue
+        if status == 'D':
+            deleted.append(name)
+        else:
+            changed.append(name)
+    return changed, deleted
+
+def read_file(path, name):
+    with open(os.path.join(path, name), encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+def load_commits(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT repo, branch, commit FROM docs_state')
+        return {(repo, branch): commit for repo, branch, commit in cur}
+
+def save_commit(cur, repo, branch, commit):
+    cur.execute("""
+        INSERT INTO docs_state (repo, branch, commit)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (repo, branch) DO UPDATE SET
+          commit = excluded.commit,
+          updated_at = now()
+    """, (repo, branch, commit))
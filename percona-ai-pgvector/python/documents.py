@@ -0,0 +1,31 @@
+# normalized layout (config.NORMALIZED_LAYOUT): a documents row per url with
+# its metadata, narrow perconavec rows (doc_id, chunk_no, embedding) and the
+# chunk text in chunk_texts, so scans of the vector heap do not read urls
+# and text; searches fetch text and url for the top rows only
+from psycopg2.extras import execute_values
+import config
+
+# the table chunk text is read from
+TEXT_TABLE = 'chunk_texts' if config.NORMALIZED_LAYOUT else 'perconavec'
+
+# pages are 02-put.py page dicts; returns url -> documents id
+def save(cur, pages):
+    rows = execute_values(cur, """
+        INSERT INTO documents (url, source, source_type, repo, branch, published_at)
+        VALUES %s
+        ON CONFLICT (url) DO UPDATE SET
+          source = excluded.source,
+          source_type = excluded.source_type,
+          repo = excluded.repo,
+          branch = excluded.branch,
+          published_at = excluded.published_at
+        RETURNING url, id
+    """, [(page['url'], page['source'], page['kind'], page.get('repo'), page.get('branch'), page.get('published_at')) for page in pages], fetch=True)
+    return dict(rows)
+
+def delete_texts(cur, ids):
+    cur.execute('DELETE FROM chunk_texts WHERE id = ANY(%s)', (ids,))
+
+# documents of deleted files, their chunks are deleted as stale rows
+def delete(cur, urls):
+    cur.execute('DELETE FROM documents WHERE url = ANY(%s)', (urls,))
@@ -0,0 +1,127 @@
+# batched vector embeddings for ingestion and search
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+import config
+
+model = None
+model_name = None
+pool = None
+pool_size = 0
+
+# 'auto' picks cuda, then apple mps, then cpu
+def pick_device(device=config.EMBED_DEVICE):
+    if device != 'auto':
+        return device
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+# deterministic stand-in for the model (EMBED_MODEL='stub') used by the
+# ingestion benchmark: unit vectors seeded by the text hash, no model work
+class StubModel:
+    def encode(self, texts, batch_size=None, show_progress_bar=False):
+        vectors = np.zeros((len(texts), config.EMBED_DIMENSIONS), dtype=np.float32)
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+            vectors[i] = np.random.default_rng(seed).standard_normal(config.EMBED_DIMENSIONS, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+# dynamic int8 quantization of the Linear layers only works on cpu
+def load_model(device=None, quantize=False, name=None):
+    name = name or config.EMBED_MODEL
+    if name == 'stub':
+        return StubModel()
+    device = device or pick_device()
+    m = SentenceTransformer(name, device=device)
+    if quantize:
+        if device != 'cpu':
+            raise ValueError('int8 quantization needs the cpu device, got %s' % device)
+        m = torch.quantization.quantize_dynamic(m, {torch.nn.Linear}, dtype=torch.qint8)
+    return m
+
+# one model at a time: asking for another one replaces it
+def get_model(name=None):
+    global model, model_name
+    name = name or config.EMBED_MODEL
+    if model is None or model_name != name:
+        model = None
+        device = pick_device()
+        model = load_model(device, config.EMBED_QUANTIZE and device == 'cpu', name)
+        model_name = name
+    return model
+
+def init_worker(quantize, threads):
+    global model, model_name
+    torch.set_num_threads(threads)
+    model = load_model('cpu', quantize)
+    model_name = config.EMBED_MODEL
+
+def encode(texts):
+    return get_model().encode(texts, batch_size=config.ENCODE_BATCH_SIZE, show_progress_bar=False)
+
+# on cpu-only nodes encode batches are sharded across worker processes. The
+# pool forks, so start it before the caller opens connections, starts threads
+# or loads a model; it is a no-op when a gpu is present or CPU_WORKERS is 1
+def start_cpu_pool(workers=config.CPU_WORKERS, quantize=config.EMBED_QUANTIZE, device=None):
+    global pool, pool_size
+    if pool is not None or workers < 2 or (device or pick_device()) != 'cpu':
+        return pool
+    threads = max(1, (os.cpu_count() or workers) // workers)
+    pool_size = workers
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'), initializer=init_worker, initargs=(quantize, threads))
+    # the first submit forks every worker
+    pool.submit(int).result()
+    return pool
+
+def stop_cpu_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+def create_embeddings(texts):
+    if pool is None:
+        return encode(texts)
+    shards = np.array_split(np.arange(len(texts)), min(len(texts), pool_size))
+    return np.concatenate(list(pool.map(encode, [[texts[i] for i in shard] for shard in shards])))
+
+# the vector of a search query, encoded in process with the model the
+# searched data was embedded with (search.live_model), which is
+# config.EMBED_MODEL until a generation with another model is swapped in
+def embed_query(text, name=None):
+    return get_model(name).encode([text], batch_size=1, show_progress_bar=False)[0]
+
+# a model that does not embed in config.EMBED_DIMENSIONS would only fail once
+# its first rows are written
+def check_dimensions():
+    dimensions = create_embeddings(['dimensions']).shape[1]
+    if dimensions != config.EMBED_DIMENSIONS:
+        raise ValueError('%s embeds in %d dimensions, the vector columns have %d (config.EMBED_DIMENSIONS)' % (config.EMBED_MODEL, dimensions, config.EMBED_DIMENSIONS))
+
+# with a chunk_cache.EmbeddingCache only chunks with an unseen content_hash
+# are encoded; near duplicates (see dedup.py) get no vector
+def embed_batch(batch, cache=None):
+    cached = cache.lookup([chunk['content_hash'] for chunk in batch]) if cache else {}
+    todo = {}
+    for chunk in batch:
+        if chunk.get('duplicate_of') is not None:
+            chunk['embedding'] = None
+        elif chunk.get('content_hash') in cached:
+            chunk['embedding'] = cached[chunk['content_hash']]
+        else:
+            todo.setdefault(chunk.get('content_hash') or id(chunk), []).append(chunk)
+    if todo:
+        groups = list(todo.values())
+        for group, vector in zip(groups, create_embeddings([group[0]['content'] for group in groups])):
+            for chunk in group:
+                chunk['embedding'] = vector
+            if cache:
+                cache.add(group[0]['content_hash'], vector)
+    return batch
@@ -0,0 +1,68 @@
+# blog page html -> text; every extractor produces the same text for a page,
+# they only differ in speed. Pick one with config.HTML_EXTRACTOR
+import re
+from datetime import datetime, timezone
+from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
+import config
+
+def clean_lines(text):
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+# from blog post - remove noisy divs
+def extract_bs4(html):
+    soup = BeautifulSoup(html, features="html.parser")
+
+    for div in soup.find_all("div", {"id": "jp-relatedposts"}):
+        div.decompose()
+    for div in soup.find_all("div", {"class": "share-wrap"}):
+        div.decompose()
+    for div in soup.find_all("div", {"class": "comments-sec"}):
+        div.decompose()
+
+    text = soup.find("div", {"class": "blog-content-inner"}).get_text()
+    return clean_lines(text)
+
+def has_class(name):
+    return 'contains(concat(" ", normalize-space(@class), " "), " %s ")' % name
+
+NOISY_DIVS = etree.XPath('//div[@id="jp-relatedposts" or %s or %s]' % (has_class('share-wrap'), has_class('comments-sec')))
+CONTENT_DIV = etree.XPath('//div[%s]' % has_class('blog-content-inner'))
+# like bs4 get_text(): no script, style or template contents and no comments
+CONTENT_TEXT = etree.XPath('.//text()[not(parent::script or parent::style or parent::template)]')
+PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+# same selection as extract_bs4 on the libxml2 parser
+def extract_lxml(html):
+    root = lxml.html.document_fromstring(html.encode('utf-8'), parser=PARSER)
+    # drop_tree() keeps the tail text, just like decompose() does
+    for div in NOISY_DIVS(root):
+        div.drop_tree()
+    content = CONTENT_DIV(root)
+    if not content:
+        raise ValueError('no blog-content-inner div in page')
+    return clean_lines(''.join(CONTENT_TEXT(content[0])))
+
+PUBLISHED_TIME = re.compile(r'<meta\s+property=["\']article:published_time["\']\s+content=["\']([^"\']+)')
+
+# article:published_time of a blog page as a tz aware datetime, None when the
+# page has none
+def published_time(html):
+    match = PUBLISHED_TIME.search(html)
+    if not match:
+        return None
+    try:
+        value = datetime.fromisoformat(match.group(1))
+    except ValueError:
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+EXTRACTORS = {
+    'bs4': extract_bs4,
+    'lxml': extract_lxml,
+}
+
+def get_extractor(name=config.HTML_EXTRACTOR):
+    return EXTRACTORS[name]
@@ -0,0 +1,120 @@
+# blue/green generations of the ingested data: a new generation (other
+# embedding model or chunking) is provisioned and loaded in the schema
+# <live>_next while searches keep using the live schema, the first one of
+# config.PGSCHEMA. The swap moves the live tables and search functions to
+# <live>_old and those of <live>_next into the live schema in one short
+# transaction; <live>_old is kept for a rollback until it is dropped
+import time
+import psycopg2
+import psycopg2.errors
+import config
+
+# everything a generation owns, perconavec partitions come along
+TABLES = ['perconavec', 'documents', 'chunk_texts', 'ingest_state', 'docs_state', 'ingest_jobs', 'generation']
+FUNCTIONS = ['match_documents', 'match_documents_filtered']
+
+def live_schema():
+    return config.PGSCHEMA.split(',')[0].strip()
+
+def next_schema():
+    return live_schema() + '_next'
+
+def old_schema():
+    return live_schema() + '_old'
+
+def connect():
+    return psycopg2.connect(
+        user=config.PGUSER,
+        password=config.PGPASSWORD,
+        database=config.PGDATABASE,
+        host=config.PGHOST,
+        port=config.PGPORT,
+    )
+
+def schema_exists(cur, schema):
+    cur.execute('SELECT 1 FROM pg_namespace WHERE nspname = %s', (schema,))
+    return cur.fetchone() is not None
+
+def tables(cur, schema):
+    cur.execute("""
+        SELECT c.relname FROM pg_class c
+        WHERE c.relnamespace = %s::regnamespace AND c.relname = ANY(%s)
+        UNION ALL
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (schema, TABLES, '%s.perconavec' % schema))
+    return [row[0] for row in cur.fetchall()]
+
+def functions(cur, schema):
+    cur.execute("""
+        SELECT proname, pg_get_function_identity_arguments(oid) FROM pg_proc
+        WHERE pronamespace = %s::regnamespace AND proname = ANY(%s)
+    """, (schema, FUNCTIONS))
+    return cur.fetchall()
+
+# indexes and owned sequences move with their tables
+def move(cur, source, target):
+    for table in tables(cur, source):
+        cur.execute('ALTER TABLE %s.%s SET SCHEMA %s' % (source, table, target))
+    for name, arguments in functions(cur, source):
+        cur.execute('ALTER FUNCTION %s.%s(%s) SET SCHEMA %s' % (source, name, arguments, target))
+
+# the generation row of a schema, None when it has none
+def info(cur, schema):
+    if not schema_exists(cur, schema):
+        return None
+    cur.execute('SELECT to_regclass(%s)', ('%s.generation' % schema,))
+    if cur.fetchone()[0] is None:
+        return {}
+    cur.execute('SELECT embed_model, chunk_tokens, chunk_overlap_tokens, created_at, swapped_at FROM %s.generation' % schema)
+    row = cur.fetchone()
+    cur.execute('SELECT count(*) FROM %s.perconavec' % schema)
+    rows = cur.fetchone()[0]
+    if row is None:
+        return {'rows': rows}
+    return dict(zip(['embed_model', 'chunk_tokens', 'chunk_overlap_tokens', 'created_at', 'swapped_at'], row), rows=rows)
+
+# searches wait for the swap at most lock_timeout, a swap that cannot get its
+# locks that fast is retried instead of queueing searches behind it
+def exchange(conn, outgoing, incoming, lock_timeout=config.SWAP_LOCK_TIMEOUT, attempts=config.SWAP_ATTEMPTS):
+    live = live_schema()
+    for attempt in range(attempts):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+                cur.execute('CREATE SCHEMA %s' % outgoing)
+                move(cur, live, outgoing)
+                move(cur, incoming, live)
+                cur.execute('DROP SCHEMA %s' % incoming)
+                cur.execute('UPDATE %s.generation SET swapped_at = now()' % live)
+            conn.commit()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            time.sleep(1)
+    raise RuntimeError('could not lock the live tables in %d attempts' % attempts)
+
+def swap(conn):
+    with conn.cursor() as cur:
+        if not schema_exists(cur, next_schema()):
+            raise RuntimeError('no generation in %s, build one first' % next_schema())
+        if schema_exists(cur, old_schema()):
+            raise RuntimeError('%s still holds the previous generation, drop it with gc first' % old_schema())
+    conn.commit()
+    exchange(conn, old_schema(), next_schema())
+
+# the previous generation goes live again, the current one ends up in
+# <live>_next where it can be swapped back in
+def rollback(conn):
+    with conn.cursor() as cur:
+        if not schema_exists(cur, old_schema()):
+            raise RuntimeError('no previous generation in %s' % old_schema())
+        if schema_exists(cur, next_schema()):
+            raise RuntimeError('%s is in use, drop it with gc --next first' % next_schema())
+    conn.commit()
+    exchange(conn, next_schema(), old_schema())
+
+def drop(conn, schema):
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+    conn.commit()
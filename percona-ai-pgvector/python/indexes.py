@@ -0,0 +1,139 @@
+# vector index lifecycle around bulk loads: drop before loading, rebuild
+# afterwards (ivfflat with lists sized to the table, or hnsw), without
+# blocking searches
+import math
+import re
+import config
+
+# perconavec rows carry a source: 'blog' or the docs repo they come from
+BLOG_SOURCE = 'blog'
+
+def index_name(table):
+    return table + '_embedding_idx'
+
+INDEX = index_name('perconavec')
+
+# optional quantized copy of the embedding (config.QUANTIZED_STORAGE) kept by
+# the database as a generated column; the ann index is built on it and
+# match_documents re-ranks its candidates against the full precision vectors
+QUANTIZED = {
+    'halfvec': {
+        'column': 'embedding_q halfvec(%d) generated always as (embedding::halfvec(%d)) stored' % (config.EMBED_DIMENSIONS, config.EMBED_DIMENSIONS),
+        'opclass': 'halfvec_cosine_ops',
+        'distance': 'perconavec.embedding_q <=> {query}::halfvec(%d)' % config.EMBED_DIMENSIONS,
+    },
+    'binary': {
+        'column': 'embedding_q bit(%d) generated always as (binary_quantize(embedding)::bit(%d)) stored' % (config.EMBED_DIMENSIONS, config.EMBED_DIMENSIONS),
+        'opclass': 'bit_hamming_ops',
+        'distance': 'perconavec.embedding_q <~> binary_quantize({query})::bit(%d)' % config.EMBED_DIMENSIONS,
+    },
+}
+
+# pgvector guidance: rows / 1000 lists up to 1M rows, sqrt(rows) above that
+def ivfflat_lists(rows):
+    if rows <= 1000000:
+        return max(10, rows // 1000)
+    return int(math.sqrt(rows))
+
+def index_target():
+    if config.QUANTIZED_STORAGE:
+        return 'embedding_q %s' % QUANTIZED[config.QUANTIZED_STORAGE]['opclass']
+    return 'embedding vector_cosine_ops'
+
+def index_method(lists):
+    if config.INDEX_TYPE == 'hnsw':
+        return 'hnsw (%s) WITH (m = %d, ef_construction = %d)' % (index_target(), config.HNSW_M, config.HNSW_EF_CONSTRUCTION)
+    return 'ivfflat (%s) WITH (lists = %d)' % (index_target(), lists)
+
+# with config.PARTITION_BY_SOURCE perconavec is list partitioned by source,
+# one partition for the blog and for every docs repo plus a default one. Each
+# partition has its own vector index, so a product is re-indexed alone
+def partition_name(source):
+    return 'perconavec_' + re.sub(r'\W+', '_', source.split('/')[-1])
+
+def partitions(sources):
+    return [(partition_name(source), source) for source in sources]
+
+def is_partitioned(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = 'perconavec'::regclass")
+        return cur.fetchone()[0] == 'p'
+
+# tables that carry a vector index: perconavec itself, or the partitions
+# holding the given sources (all of them when sources is None)
+def indexed_tables(conn, sources=None):
+    if not is_partitioned(conn):
+        return ['perconavec']
+    with conn.cursor() as cur:
+        cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'perconavec'::regclass ORDER BY 1")
+        tables = [row[0] for row in cur]
+    if sources is None:
+        return tables
+    wanted = set(partition_name(source) for source in sources)
+    return [table for table in tables if table in wanted]
+
+# index names are qualified with the schema perconavec lives in, the
+# search_path may hold another schema with indexes of the same name
+def schema(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT relnamespace::regnamespace::text FROM pg_class WHERE oid = 'perconavec'::regclass")
+        return cur.fetchone()[0]
+
+def qualified(conn, name):
+    return '%s.%s' % (schema(conn), name)
+
+def has_index(conn, table='perconavec'):
+    with conn.cursor() as cur:
+        cur.execute('SELECT to_regclass(%s)', (qualified(conn, index_name(table)),))
+        return cur.fetchone()[0] is not None
+
+def missing_indexes(conn):
+    return [table for table in indexed_tables(conn) if not has_index(conn, table)]
+
+# CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block
+def run_autocommit(conn, statements):
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+    finally:
+        conn.autocommit = autocommit
+
+def drop_index(conn, sources=None):
+    run_autocommit(conn, ['DROP INDEX CONCURRENTLY IF EXISTS %s' % qualified(conn, index_name(table)) for table in indexed_tables(conn, sources)])
+
+# the new index is built next to the old one and swapped in by name, so
+# searches keep using the old index until the new one is ready. ivfflat lists
+# are sized to the rows with a vector of each table unless given, near
+# duplicates have none and are not indexed; a table (or partition) without
+# vectors gets no ivfflat index, its lists would be trained on no rows, and is
+# indexed by the first build after it is loaded. hnsw needs no training
+def build_index(conn, lists=None, sources=None):
+    for table in indexed_tables(conn, sources):
+        build_table_index(conn, table, lists)
+
+def build_table_index(conn, table, lists=None):
+    index = index_name(table)
+    name = qualified(conn, index)
+    with conn.cursor() as cur:
+        cur.execute('SELECT count(embedding) FROM %s' % table)
+        vectors = cur.fetchone()[0]
+    if not vectors and config.INDEX_TYPE != 'hnsw':
+        print('not building %s, %s has no vectors' % (index, table))
+        return
+    method = index_method(lists or ivfflat_lists(vectors))
+    print('building %s on %d vectors using %s' % (index, vectors, method))
+    run_autocommit(conn, [
+        "SET maintenance_work_mem = '%s'" % config.INDEX_MAINTENANCE_WORK_MEM,
+        'SET max_parallel_maintenance_workers = %d' % config.INDEX_PARALLEL_WORKERS,
+        # left over by an interrupted build
+        'DROP INDEX CONCURRENTLY IF EXISTS %s_new' % name,
+        'CREATE INDEX CONCURRENTLY %s_new ON %s USING %s' % (index, table, method),
+        'DROP INDEX CONCURRENTLY IF EXISTS %s' % name,
+        'ALTER INDEX %s_new RENAME TO %s' % (name, index),
+        'RESET maintenance_work_mem',
+        'RESET max_parallel_maintenance_workers',
+    ])
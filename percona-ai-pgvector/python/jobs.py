@@ -0,0 +1,160 @@
+# ingestion work queue in the ingest_jobs table: 02-put.py --enqueue adds a
+# job per blog page or docs file to (re)ingest, any number of 02-put.py
+# --worker processes on any node claim them with FOR UPDATE SKIP LOCKED.
+# A claimed job is leased to its worker, which keeps extending the lease
+# while it runs; jobs of a worker that died are claimed again once their
+# lease expired, up to config.JOB_MAX_ATTEMPTS times
+import os
+import socket
+import threading
+from psycopg2.extras import Json, execute_values
+import config
+
+STATUSES = ['pending', 'running', 'done', 'failed']
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+# pages are 02-put.py page dicts; a job that is running keeps its payload and
+# is enqueued again by the next run if it is still out of date then
+def enqueue(cur, pages):
+    execute_values(cur, """
+        INSERT INTO ingest_jobs (url, kind, source, payload)
+        VALUES %s
+        ON CONFLICT (url) DO UPDATE SET
+          kind = excluded.kind,
+          source = excluded.source,
+          payload = excluded.payload,
+          status = 'pending',
+          attempts = 0,
+          leased_by = NULL,
+          lease_until = NULL,
+          last_error = NULL,
+          updated_at = now()
+        WHERE ingest_jobs.status <> 'running'
+    """, [(page['url'], page['kind'], page['source'], Json(page['payload'])) for page in pages])
+
+# pending jobs whose retry delay is over and running jobs whose lease expired;
+# jobs out of attempts are failed instead
+def claim(conn, worker, count=config.JOB_CLAIM_SIZE, lease=config.JOB_LEASE, max_attempts=config.JOB_MAX_ATTEMPTS):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ingest_jobs SET status = 'failed', leased_by = NULL, updated_at = now(),
+              last_error = coalesce(last_error, 'lease expired')
+            WHERE status = 'running' AND lease_until < now() AND attempts >= %s
+        """, (max_attempts,))
+        cur.execute("""
+            UPDATE ingest_jobs SET
+              status = 'running',
+              attempts = attempts + 1,
+              leased_by = %s,
+              lease_until = now() + %s * interval '1 second',
+              updated_at = now()
+            WHERE id IN (
+              SELECT id FROM ingest_jobs
+              WHERE status IN ('pending', 'running')
+                AND (lease_until IS NULL OR lease_until < now())
+              ORDER BY id
+              LIMIT %s
+              FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, url, kind, source, payload, attempts
+        """, (worker, lease, count))
+        jobs = [{'id': id, 'url': url, 'kind': kind, 'source': source, 'payload': payload, 'attempts': attempts}
+                for id, url, kind, source, payload, attempts in cur.fetchall()]
+    conn.commit()
+    return sorted(jobs, key=lambda job: job['id'])
+
+# the lease of every job the worker still runs
+def extend_leases(conn, worker, lease=config.JOB_LEASE):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ingest_jobs SET lease_until = now() + %s * interval '1 second'
+            WHERE leased_by = %s AND status = 'running'
+        """, (lease, worker))
+    conn.commit()
+
+# the jobs still leased to the worker, locked until the caller commits, so
+# their results are written at most once
+def lock_owned(cur, ids, worker):
+    cur.execute("""
+        SELECT id FROM ingest_jobs
+        WHERE id = ANY(%s) AND leased_by = %s AND status = 'running'
+        FOR UPDATE
+    """, (ids, worker))
+    return set(row[0] for row in cur.fetchall())
+
+def complete(cur, ids):
+    cur.execute("""
+        UPDATE ingest_jobs SET status = 'done', leased_by = NULL, lease_until = NULL, last_error = NULL, updated_at = now()
+        WHERE id = ANY(%s)
+    """, (ids,))
+
+# a failed job is retried after config.JOB_RETRY_DELAY seconds times its
+# attempts so far, unless it is out of attempts
+def fail(conn, id, worker, error, max_attempts=config.JOB_MAX_ATTEMPTS, delay=config.JOB_RETRY_DELAY):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ingest_jobs SET
+              status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+              leased_by = NULL,
+              lease_until = now() + attempts * %s * interval '1 second',
+              last_error = %s,
+              updated_at = now()
+            WHERE id = %s AND leased_by = %s
+        """, (max_attempts, delay, error, id, worker))
+    conn.commit()
+
+# jobs per status, and per source for those not done
+def progress(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT status, count(*) FROM ingest_jobs GROUP BY status')
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(cur.fetchall())
+        cur.execute("SELECT source, status, count(*) FROM ingest_jobs WHERE status <> 'done' GROUP BY source, status ORDER BY source, status")
+        sources = {}
+        for source, status, count in cur.fetchall():
+            sources.setdefault(source, {})[status] = count
+    conn.commit()
+    return counts, sources
+
+# pending or running jobs left, of any worker
+def unfinished(conn):
+    counts, sources = progress(conn)
+    return counts['pending'] + counts['running']
+
+# failed jobs are given their attempts back
+def retry_failed(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ingest_jobs SET status = 'pending', attempts = 0, lease_until = NULL, updated_at = now()
+            WHERE status = 'failed'
+        """)
+        count = cur.rowcount
+    conn.commit()
+    return count
+
+# extends the worker's leases every third of config.JOB_LEASE on its own
+# connection until stopped
+class Heartbeat:
+    def __init__(self, connect, worker, lease=config.JOB_LEASE):
+        self.connect = connect
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='heartbeat', daemon=True)
+
+    def loop(self):
+        conn = self.connect()
+        try:
+            while not self.stopped.wait(self.lease / 3):
+                extend_leases(conn, self.worker, self.lease)
+        finally:
+            conn.close()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
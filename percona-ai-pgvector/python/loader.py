@@ -0,0 +1,103 @@
+# bulk writes into perconavec with binary COPY
+import io
+import struct
+from datetime import datetime, timezone
+import numpy as np
+import config
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+NULL = struct.pack('!i', -1)
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def encode_text(value):
+    data = value.encode('utf-8')
+    return struct.pack('!i', len(data)) + data
+
+# timestamptz: int64 microseconds since 2000-01-01 UTC, value is tz aware
+def encode_timestamp(value):
+    delta = value - PG_EPOCH
+    return struct.pack('!iq', 8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+def encode_bigint(value):
+    return struct.pack('!iq', 8, value)
+
+def encode_int(value):
+    return struct.pack('!ii', 4, value)
+
+# pgvector binary format: int16 dim, int16 unused, dim big-endian float4
+def encode_vector(value):
+    data = np.asarray(value, dtype='>f4')
+    return struct.pack('!ihh', 4 + 4 * data.shape[0], data.shape[0], 0) + data.tobytes()
+
+# chunk dict key and binary encoder for every copied column; id is only
+# copied when the rows come with one (dedup.Deduper), else the sequence
+# fills it in
+WIDE_COLUMNS = [
+    ('id', encode_bigint),
+    ('content', encode_text),
+    ('url', encode_text),
+    ('source', encode_text),
+    ('content_hash', encode_text),
+    ('embedding', encode_vector),
+    ('source_type', encode_text),
+    ('repo', encode_text),
+    ('branch', encode_text),
+    ('published_at', encode_timestamp),
+    ('simhash', encode_bigint),
+    ('duplicate_of', encode_bigint),
+]
+
+# config.NORMALIZED_LAYOUT, see documents.py: rows always come with their id
+# and the text goes to chunk_texts
+NARROW_COLUMNS = [
+    ('id', encode_bigint),
+    ('doc_id', encode_bigint),
+    ('chunk_no', encode_int),
+    ('source', encode_text),
+    ('content_hash', encode_text),
+    ('embedding', encode_vector),
+    ('simhash', encode_bigint),
+    ('duplicate_of', encode_bigint),
+]
+TEXT_COLUMNS = [
+    ('id', encode_bigint),
+    ('content', encode_text),
+]
+
+COLUMNS = NARROW_COLUMNS if config.NORMALIZED_LAYOUT else WIDE_COLUMNS
+
+def copy_columns(rows):
+    return [(column, encode) for column, encode in COLUMNS if column != 'id' or (rows and 'id' in rows[0])]
+
+def copy_buffer(rows, columns):
+    buf = io.BytesIO()
+    buf.write(COPY_HEADER)
+    for row in rows:
+        buf.write(struct.pack('!h', len(columns)))
+        for column, encode in columns:
+            value = row.get(column)
+            buf.write(NULL if value is None else encode(value))
+    buf.write(COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+def copy_table(cur, table, rows, columns):
+    names = ', '.join(column for column, encode in columns)
+    cur.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT BINARY)' % (table, names), copy_buffer(rows, columns))
+
+def assign_ids(cur, rows):
+    cur.execute("SELECT nextval(pg_get_serial_sequence('perconavec', 'id')) FROM generate_series(1, %s)", (len(rows),))
+    for row, (id,) in zip(rows, cur.fetchall()):
+        row['id'] = id
+
+# rows is a list of chunk dicts; one COPY (two with the normalized layout)
+# and one commit per call
+def copy_rows(conn, rows):
+    with conn.cursor() as cur:
+        if config.NORMALIZED_LAYOUT and rows:
+            if 'id' not in rows[0]:
+                assign_ids(cur, rows)
+            copy_table(cur, 'chunk_texts', rows, TEXT_COLUMNS)
+        copy_table(cur, 'perconavec', rows, copy_columns(rows))
+    conn.commit()
@@ -0,0 +1,196 @@
+# in-process search backends over a snapshot directory (snapshot.py,
+# 07-export.py), for development and CI without Postgres. They return the
+# rows of match_documents, with its threshold, filters, sources and near
+# duplicate handling, from the memory-mapped embedding matrix:
+#   ExactBackend  cosine similarity of every vector, block by block
+#   IvfBackend    spherical k-means lists like an ivfflat index, trained on
+#                 first use and cached in the snapshot directory; a search
+#                 scans the config.SEARCH_PROBES lists closest to the query
+import os
+from datetime import datetime, timezone
+import numpy as np
+import config
+import indexes
+import search
+import snapshot
+
+# matrix rows per block, bounds the float32 copy a scan makes of a float16
+# or memory-mapped matrix
+BLOCK_ROWS = 65536
+# k-means: rows sampled per list (as ivfflat does) and iterations
+IVF_SAMPLE = 50
+IVF_ITERATIONS = 10
+
+def microseconds(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return snapshot.microseconds(value)
+
+class ExactBackend:
+    def __init__(self, path):
+        self.snap = snapshot.Snapshot(path)
+        self.model = (self.snap.meta['generation'] or {}).get('embed_model') or config.EMBED_MODEL
+        self.embeddings = self.snap.embeddings
+        self.vectors = len(self.embeddings)
+        self.norms = np.concatenate([np.linalg.norm(block, axis=1) for block in self.blocks()] or [np.zeros(0, dtype=np.float32)])
+        # near duplicates (rows after the vectors) and the matrix rows of
+        # their canonical rows
+        self.duplicate_rows = np.zeros(0, dtype=np.int64)
+        self.parents = np.zeros(0, dtype=np.int64)
+        if config.NEAR_DUP_DISTANCE is not None:
+            parents = self.snap.integers['duplicate_of'][self.vectors:]
+            positions = np.minimum(np.searchsorted(self.snap.ids[:self.vectors], parents), max(self.vectors - 1, 0))
+            found = self.snap.ids[positions] == parents if self.vectors else np.zeros(len(parents), dtype=bool)
+            self.duplicate_rows = self.vectors + np.flatnonzero(found)
+            self.parents = positions[found]
+
+    def blocks(self, start=0, stop=None):
+        stop = self.vectors if stop is None else stop
+        for offset in range(start, stop, BLOCK_ROWS):
+            yield np.asarray(self.embeddings[offset:min(offset + BLOCK_ROWS, stop)], dtype=np.float32)
+
+    # 1 - cosine distance, nan for zero vectors like pgvector
+    def similarities(self, query, rows=None):
+        query = np.asarray(query, dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if rows is None:
+                dots = np.concatenate([block @ query for block in self.blocks()] or [np.zeros(0, dtype=np.float32)])
+                return dots / (self.norms * np.linalg.norm(query))
+            return np.asarray(self.embeddings[rows], dtype=np.float32) @ query / (self.norms[rows] * np.linalg.norm(query))
+
+    # a condition on every snapshot row, applied to the matrix rows: a
+    # canonical row passes when it or one of its duplicates does
+    def matching(self, passes):
+        result = passes[:self.vectors].copy()
+        np.logical_or.at(result, self.parents, passes[self.duplicate_rows])
+        return result
+
+    def codes(self, name, values):
+        dictionary = self.snap.meta['dictionaries'][name]
+        wanted = [dictionary.index(value) for value in values if value in dictionary]
+        return np.isin(self.snap.codes[name], wanted)
+
+    # the matrix rows a search may return, None for all of them
+    def mask(self, filters):
+        filters = search.check_filters(filters)
+        conditions = []
+        if config.SEARCH_SOURCES is not None and not filters:
+            conditions.append(self.codes('source', config.SEARCH_SOURCES))
+        if 'source_types' in filters:
+            conditions.append(self.codes('source_type', filters['source_types']))
+        if 'repos' in filters:
+            conditions.append(self.codes('source', filters['repos']))
+        if 'branches' in filters:
+            conditions.append(self.codes('branch', filters['branches']))
+        published = self.snap.published_at
+        if 'published_after' in filters:
+            conditions.append((published != snapshot.NULL) & (published >= microseconds(filters['published_after'])))
+        if 'published_before' in filters:
+            conditions.append((published != snapshot.NULL) & (published < microseconds(filters['published_before'])))
+        if not conditions:
+            return None
+        mask = np.ones(self.vectors, dtype=bool)
+        for passes in conditions:
+            mask &= self.matching(passes)
+        return mask
+
+    def row(self, position, similarity):
+        url = self.snap.string('url', position)
+        urls = [url] + [self.snap.string('url', i) for i in self.duplicate_rows[self.parents == position]]
+        return (int(self.snap.ids[position]), self.snap.string('content', position), url, float(similarity), urls)
+
+    # the count best of rows (all matrix rows when None) with their
+    # similarities, above the threshold as match_documents has it
+    def best(self, rows, similarities, threshold, count):
+        keep = 1 - similarities < 1 - threshold
+        if rows is None:
+            rows = np.arange(self.vectors)
+        rows, similarities = rows[keep], similarities[keep]
+        if len(rows) > count:
+            top = np.argpartition(-similarities, count - 1)[:count]
+            rows, similarities = rows[top], similarities[top]
+        order = np.argsort(-similarities, kind='stable')
+        return [self.row(int(rows[i]), similarities[i]) for i in order]
+
+    # a snapshot does not change, the model of the query is not checked
+    def search(self, embedding, threshold, count, filters=config.SEARCH_FILTERS, model=None):
+        similarities = self.similarities(embedding)
+        mask = self.mask(filters)
+        if mask is not None:
+            similarities = np.where(mask, similarities, np.nan)
+        return self.best(None, similarities, threshold, count)
+
+    def close(self):
+        pass
+
+class IvfBackend(ExactBackend):
+    def __init__(self, path, lists=None):
+        super().__init__(path)
+        if not self.vectors:
+            raise ValueError('no vectors in the snapshot %s' % path)
+        self.lists = max(1, min(lists or config.LOCAL_IVF_LISTS or indexes.ivfflat_lists(self.vectors), self.vectors))
+        # trained for this export of the snapshot only
+        stamp = ''.join(c for c in self.snap.meta['exported_at'] if c.isdigit())
+        cache = os.path.join(path, 'ivf-%d-%d-%s.npz' % (self.lists, self.vectors, stamp))
+        if os.path.exists(cache):
+            with np.load(cache) as data:
+                self.centroids, self.order, self.offsets = data['centroids'], data['order'], data['offsets']
+        else:
+            self.train()
+            try:
+                np.savez(cache, centroids=self.centroids, order=self.order, offsets=self.offsets)
+            except OSError:
+                # a read-only snapshot is trained again next time
+                pass
+
+    def unit(self, block):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num(block / np.linalg.norm(block, axis=1, keepdims=True))
+
+    def assign(self, block):
+        return np.argmax(self.unit(block) @ self.centroids.T, axis=1)
+
+    def train(self):
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(self.vectors, min(self.vectors, self.lists * IVF_SAMPLE), replace=False))
+        points = self.unit(np.asarray(self.embeddings[sample], dtype=np.float32))
+        self.centroids = points[rng.choice(len(points), self.lists, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            labels = self.assign(points)
+            for i in range(self.lists):
+                members = points[labels == i]
+                # an empty list starts over from a random sample row
+                centroid = members.sum(axis=0) if len(members) else points[rng.integers(len(points))]
+                self.centroids[i] = centroid / (np.linalg.norm(centroid) or 1)
+        labels = np.concatenate([self.assign(block) for block in self.blocks()])
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.searchsorted(labels[self.order], np.arange(self.lists + 1))
+
+    # probes lists at a time, closest centroid first; with
+    # config.SEARCH_ITERATIVE_SCAN and a filter the scan goes on until count
+    # rows pass it, like an iterative index scan
+    def search(self, embedding, threshold, count, filters=config.SEARCH_FILTERS, model=None):
+        probes = config.SEARCH_PROBES or 1
+        mask = self.mask(filters)
+        lists = np.argsort(-(self.centroids @ np.asarray(embedding, dtype=np.float32)), kind='stable')
+        rows = np.zeros(0, dtype=np.int64)
+        for start in range(0, self.lists, probes):
+            scanned = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists[start:start + probes]]
+            rows = np.concatenate([rows] + scanned)
+            passing = rows if mask is None else rows[mask[rows]]
+            if mask is None or not config.SEARCH_ITERATIVE_SCAN or len(passing) >= count:
+                break
+        passing = np.sort(passing)
+        return self.best(passing, self.similarities(embedding, passing), threshold, count)
+
+BACKENDS = {
+    'exact': ExactBackend,
+    'ivf': IvfBackend,
+}
+
+def open_backend(name, path):
+    if name not in BACKENDS:
+        raise ValueError('unknown search backend: %s' % name)
+    return BACKENDS[name](path)
@@ -0,0 +1,123 @@
+# ingestion metrics: counters, bytes and busy time per stage or step, queue
+# depths sampled in the background, a periodic progress line and a final
+# json report
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import config
+
+class Metrics:
+    def __init__(self, interval=config.METRICS_INTERVAL, profile_stage=config.PROFILE_STAGE):
+        self.interval = interval
+        self.profile_stage = profile_stage
+        self.lock = threading.Lock()
+        # name -> counters; seconds is busy time, *_wait time blocked on queues
+        self.stats = {}
+        # queue name -> (queue, [samples, total depth, max depth])
+        self.queues = {}
+        self.profiles = []
+        self.started = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, name, **counters):
+        with self.lock:
+            stat = self.stats.setdefault(name, defaultdict(float))
+            for key, value in counters.items():
+                stat[key] += value
+
+    def record(self, name, seconds, **counters):
+        self.add(name, seconds=seconds, **counters)
+        with self.lock:
+            stat = self.stats[name]
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+
+    @contextmanager
+    def timed(self, name, **counters):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, calls=1, **counters)
+
+    # passes items through, counting them and the time spent producing them
+    def meter(self, name, items):
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            item = next(items, None)
+            if item is None:
+                self.record(name, time.perf_counter() - start)
+                return
+            self.record(name, time.perf_counter() - start, items_out=1)
+            yield item
+
+    def watch(self, name, q):
+        self.queues[name] = (q, [0, 0, 0])
+
+    # a cProfile of the stage named by config.PROFILE_STAGE, one worker thread
+    def profiler(self, stage, worker):
+        if stage != self.profile_stage or worker != 0:
+            return None
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        return profile
+
+    def sample(self):
+        for q, depth in self.queues.values():
+            size = q.qsize()
+            depth[0] += 1
+            depth[1] += size
+            depth[2] = max(depth[2], size)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def progress(self):
+        elapsed = self.elapsed()
+        with self.lock:
+            parts = ['%s %d (%.1f/s)' % (name, stat['items_out'], stat['items_out'] / elapsed) for name, stat in self.stats.items() if 'items_out' in stat]
+        queues = ' '.join('%s:%d' % (name, q.qsize()) for name, (q, depth) in self.queues.items())
+        return '[%5ds] %s | queues %s' % (elapsed, ' | '.join(parts), queues)
+
+    def loop(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(1):
+            self.sample()
+            if self.interval and time.perf_counter() - last >= self.interval:
+                print(self.progress(), file=sys.stderr, flush=True)
+                last = time.perf_counter()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.loop, name='metrics', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def report(self):
+        elapsed = self.elapsed()
+        stats = {}
+        with self.lock:
+            for name, stat in self.stats.items():
+                stats[name] = dict(stat)
+                if 'items_out' in stat:
+                    stats[name]['per_second'] = stat['items_out'] / elapsed
+        queues = {}
+        for name, (q, (samples, total, deepest)) in self.queues.items():
+            queues[name] = {'maxsize': q.maxsize, 'mean_depth': total / samples if samples else 0, 'max_depth': deepest}
+        return {'seconds': elapsed, 'stats': stats, 'queues': queues}
+
+    def write_report(self, path=config.METRICS_REPORT):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+        if self.profiles:
+            pstats.Stats(*self.profiles).dump_stats(config.PROFILE_PATH % self.profile_stage)
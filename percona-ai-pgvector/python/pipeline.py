@@ -0,0 +1,148 @@
+# staged producer/consumer pipeline: every stage runs its own worker threads
+# and stages are connected by bounded queues, so a slow stage blocks the ones
+# feeding it instead of letting items pile up in memory
+import queue
+import threading
+import time
+import config
+
+DONE = object()
+IDLE = object()
+
+class Stage:
+    # func(item) returns an iterable of items for the next stage; with
+    # batch_size set, func gets a list of items whose weight adds up to at
+    # least batch_size (or whatever is left when the input ends or stays
+    # empty for config.PIPELINE_FLUSH_INTERVAL seconds)
+    def __init__(self, name, func, workers=1, batch_size=None, weight=lambda item: 1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.weight = weight
+
+# with a metrics.Metrics every stage records its calls, items in and out,
+# busy seconds and the time its workers wait on their queues
+class Pipeline:
+    def __init__(self, source, stages, queue_size=config.PIPELINE_QUEUE_SIZE, metrics=None):
+        self.source = source
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.failed = threading.Event()
+        self.errors = []
+        self.metrics = metrics
+        if metrics:
+            for stage, q in zip(stages, self.queues):
+                metrics.watch(stage.name, q)
+            metrics.watch('output', self.queues[-1])
+
+    # put and get return the seconds they waited; get returns IDLE when
+    # nothing arrived within timeout
+    def put(self, q, item):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return time.perf_counter() - start
+            except queue.Full:
+                pass
+        raise PipelineAborted()
+
+    def get(self, q, timeout=None):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=0.5), time.perf_counter() - start
+            except queue.Empty:
+                if timeout is not None and time.perf_counter() - start >= timeout:
+                    return IDLE, time.perf_counter() - start
+        raise PipelineAborted()
+
+    def guard(self, target, *args):
+        try:
+            target(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            self.errors.append(e)
+            self.failed.set()
+
+    def feed(self):
+        for item in self.source:
+            self.put(self.queues[0], item)
+        self.put(self.queues[0], DONE)
+
+    # runs func on one item or batch and passes its output on; the time spent
+    # blocked on outbox does not count as busy time
+    def call(self, stage, arg, items, outbox):
+        start = time.perf_counter()
+        waited, produced = 0, 0
+        for out in stage.func(arg):
+            waited += self.put(outbox, out)
+            produced += 1
+        if self.metrics:
+            self.metrics.record(stage.name, time.perf_counter() - start - waited, calls=1, items_in=items, items_out=produced, put_wait=waited)
+
+    # the last worker of a stage to see DONE passes it on to the next stage
+    def work(self, stage, inbox, outbox, running, worker=0):
+        profile = self.metrics.profiler(stage.name, worker) if self.metrics else None
+        if profile:
+            profile.enable()
+        try:
+            self.work_items(stage, inbox, outbox)
+        finally:
+            if profile:
+                profile.disable()
+        with running['lock']:
+            running['workers'] -= 1
+            last = running['workers'] == 0
+        if last:
+            self.put(outbox, DONE)
+
+    def work_items(self, stage, inbox, outbox):
+        batch, weight = [], 0
+        while True:
+            item, waited = self.get(inbox, config.PIPELINE_FLUSH_INTERVAL if batch else None)
+            if self.metrics:
+                self.metrics.add(stage.name, get_wait=waited)
+            if item is IDLE:
+                self.call(stage, batch, len(batch), outbox)
+                batch, weight = [], 0
+                continue
+            if item is DONE:
+                self.put(inbox, DONE)
+                break
+            if stage.batch_size is None:
+                self.call(stage, item, 1, outbox)
+                continue
+            batch.append(item)
+            weight += stage.weight(item)
+            if weight >= stage.batch_size:
+                self.call(stage, batch, len(batch), outbox)
+                batch, weight = [], 0
+        if batch:
+            self.call(stage, batch, len(batch), outbox)
+
+    # runs all stages and yields what the last one produces
+    def run(self):
+        threads = [threading.Thread(target=self.guard, args=(self.feed,), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            running = {'lock': threading.Lock(), 'workers': stage.workers}
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=self.guard, args=(self.work, stage, self.queues[i], self.queues[i + 1], running, n), name='%s-%d' % (stage.name, n), daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while (item := self.get(self.queues[-1])[0]) is not DONE:
+                yield item
+        except PipelineAborted:
+            raise self.errors[0]
+        finally:
+            self.failed.set()
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+class PipelineAborted(Exception):
+    pass
@@ -0,0 +1,97 @@
+# match_documents / match_documents_filtered calls shared by the search
+# scripts, and the search backends (config.SEARCH_BACKEND) they go through
+import psycopg2
+from pgvector.psycopg2 import register_vector
+import config
+
+# match_documents_filtered arguments, all optional
+FILTERS = ['source_types', 'repos', 'branches', 'published_after', 'published_before']
+
+# queries have to be encoded with the model of the live generation, which a
+# swap (06-generation.py) can change under a running search service; a
+# schema without a generation row was embedded with config.EMBED_MODEL
+def live_model(cur):
+    cur.execute("SELECT to_regclass('generation')")
+    if cur.fetchone()[0] is None:
+        return config.EMBED_MODEL
+    cur.execute('SELECT embed_model FROM generation')
+    row = cur.fetchone()
+    return (row and row[0]) or config.EMBED_MODEL
+
+# the query was encoded with another model than the live generation's, it
+# has to be encoded again with model
+class ModelChanged(Exception):
+    def __init__(self, model):
+        super().__init__('the live generation is embedded with %s' % model)
+        self.model = model
+
+# the given filters, without the unset ones
+def check_filters(filters):
+    filters = {name: value for name, value in (filters or {}).items() if value is not None}
+    unknown = set(filters) - set(FILTERS)
+    if unknown:
+        raise ValueError('unknown search filters: %s' % ', '.join(sorted(unknown)))
+    return filters
+
+# runs the search on cur and leaves the rows (id, content, url, similarity,
+# urls) to be fetched; urls adds those of the row's near duplicates
+def match(cur, embedding, threshold, count, filters=config.SEARCH_FILTERS):
+    filters = check_filters(filters)
+    if not filters:
+        cur.callproc('match_documents', (embedding, threshold, count, config.SEARCH_PROBES, config.SEARCH_EF_SEARCH, config.RERANK_FACTOR, config.SEARCH_SOURCES))
+        return
+    args = dict(filters, probes=config.SEARCH_PROBES, ef_search=config.SEARCH_EF_SEARCH, rerank_factor=config.RERANK_FACTOR, iterative_scan=config.SEARCH_ITERATIVE_SCAN)
+    named = ''.join(', %s => %%(%s)s' % (name, name) for name in args)
+    args.update(query_embedding=embedding, match_threshold=threshold, match_count=count)
+    cur.execute('SELECT * FROM match_documents_filtered(%%(query_embedding)s, %%(match_threshold)s, %%(match_count)s%s)' % named, args)
+
+# a backend's search() returns the rows of match_documents, (id, content,
+# url, similarity, urls), most similar first. 'postgres' calls
+# match_documents; 'exact' and 'ivf' search the snapshot in
+# config.SEARCH_SNAPSHOT in process, see local_search.py. backend.model is
+# the model to encode queries with; search() raises ModelChanged when the
+# query's model, if given, is no longer the one of the data
+class PostgresBackend:
+    def __init__(self):
+        self.conn = psycopg2.connect(
+            user=config.PGUSER,
+            password=config.PGPASSWORD,
+            database=config.PGDATABASE,
+            host=config.PGHOST,
+            port=config.PGPORT,
+        )
+        with self.conn.cursor() as cur:
+            cur.execute("SET search_path TO " + config.PGSCHEMA)
+            self.model = live_model(cur)
+        self.conn.commit()
+        register_vector(self.conn)
+
+    # the generation row read first stays locked until the search commits, so
+    # a swap cannot come in between the model check and the search
+    def search(self, embedding, threshold, count, filters=config.SEARCH_FILTERS, model=None):
+        try:
+            with self.conn.cursor() as cur:
+                if model is not None:
+                    self.model = live_model(cur)
+                    if self.model != model:
+                        raise ModelChanged(self.model)
+                match(cur, embedding, threshold, count, filters)
+                rows = cur.fetchall()
+        except Exception:
+            # a failed search does not leave the connection in an aborted
+            # transaction for the next one
+            if not self.conn.closed:
+                self.conn.rollback()
+            raise
+        self.conn.commit()
+        return rows
+
+    def close(self):
+        self.conn.close()
+
+def open_backend(name=None):
+    name = name or config.SEARCH_BACKEND
+    if name == 'postgres':
+        return PostgresBackend()
+    import local_search
+    return local_search.open_backend(name, config.SEARCH_SNAPSHOT)
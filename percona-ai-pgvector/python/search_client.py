@@ -0,0 +1,78 @@
+# client of the search service (search_service.py, 09-search-service.py):
+# posts the query text over HTTP, on a tcp port or a unix socket, and returns
+# the rows of match_documents, (id, content, url, similarity, urls). Without
+# a service it searches in process, which loads the model of the searched
+# data first; the model and database modules are only imported then, so a
+# client starts fast
+import http.client
+import json
+import socket
+import sys
+import config
+
+# 'host:port', or the path of a unix socket
+def address(service):
+    if '/' in service:
+        return service
+    host, port = service.rsplit(':', 1)
+    return host, int(port)
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def connect(service, timeout=config.SEARCH_SERVICE_TIMEOUT):
+    target = address(service)
+    if isinstance(target, str):
+        return UnixConnection(target, timeout)
+    return http.client.HTTPConnection(*target, timeout=timeout)
+
+# one request on a new connection; errors of the service are raised as
+# RuntimeError
+def request(service, method, path, body=None):
+    conn = connect(service)
+    try:
+        conn.request(method, path, body and json.dumps(body, default=str), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        data = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError('search service: %s' % data.get('error'))
+    return data
+
+def search_service(service, query, threshold, count, filters):
+    data = request(service, 'POST', '/search', {'query': query, 'threshold': threshold, 'count': count, 'filters': filters})
+    return [(row['id'], row['content'], row['url'], row['similarity'], row['urls']) for row in data['rows']]
+
+def search_local(query, threshold, count, filters):
+    import embedding
+    import search
+    backend = search.open_backend()
+    model = backend.model
+    try:
+        # encoded again when a generation with another model was swapped in
+        # since the backend opened
+        while True:
+            try:
+                return backend.search(embedding.embed_query(query, model), threshold, count, filters, model=model)
+            except search.ModelChanged as e:
+                model = e.model
+    finally:
+        backend.close()
+
+def search(query, threshold, count, filters=config.SEARCH_FILTERS):
+    if config.SEARCH_SERVICE:
+        try:
+            return search_service(config.SEARCH_SERVICE, query, threshold, count, filters)
+        # nothing listening on the port or socket; a service that fails
+        # the query is an error, not a reason to load the model here
+        except (ConnectionRefusedError, FileNotFoundError):
+            print('no search service at %s, searching in process' % config.SEARCH_SERVICE, file=sys.stderr)
+    return search_local(query, threshold, count, filters)
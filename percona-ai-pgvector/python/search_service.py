@@ -0,0 +1,189 @@
+# resident search service: the embedding model is loaded once and searches
+# go through a pool of open backends (config.SEARCH_BACKEND), so a query
+# costs an encode and a match_documents call instead of a model load and a
+# new connection. Queries are encoded with the model of the live generation,
+# the first search after a swap to another model loads it. JSON over HTTP on
+# config.SEARCH_SERVICE, a tcp port or a unix socket:
+#   POST /search {"query": text, "threshold": 0, "count": 5, "filters": {...}}
+#     -> {"rows": [{"id", "content", "url", "similarity", "urls"}, ...]}
+#   GET /health -> backend, model, searches served and their p50/p99 in ms
+import collections
+import http.server
+import json
+import os
+import queue
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import time
+import numpy as np
+import psycopg2
+import config
+import embedding
+import search
+import search_client
+
+# search latencies kept for /health
+LATENCIES = 1000
+
+# config.SEARCH_SERVICE_BACKENDS postgres backends, each with its connection;
+# the in-process backends are read only and one is shared. Warm connections
+# are reused first
+class Backends:
+    def __init__(self, size=config.SEARCH_SERVICE_BACKENDS, name=None):
+        self.name = name or config.SEARCH_BACKEND
+        self.idle = queue.LifoQueue()
+        shared = None if self.name == 'postgres' else search.open_backend(self.name)
+        for _ in range(size):
+            backend = shared or search.open_backend(self.name)
+            self.model = backend.model
+            self.idle.put(backend)
+
+    def search(self, vector, threshold, count, filters, model):
+        backend = self.idle.get()
+        try:
+            return backend.search(vector, threshold, count, filters, model=model)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the connection is gone, the next search on this slot tries a
+            # new one
+            backend.close()
+            try:
+                backend = search.open_backend(self.name)
+            except psycopg2.OperationalError:
+                pass
+            raise
+        finally:
+            self.idle.put(backend)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+class Service:
+    def __init__(self):
+        # encodes run one at a time, concurrent ones would only compete for
+        # the same cores or gpu
+        self.encoding = threading.Lock()
+        self.backends = Backends()
+        self.model = self.backends.model
+        with self.encoding:
+            embedding.embed_query('warm up', self.model)
+        self.latencies = collections.deque(maxlen=LATENCIES)
+        self.searches = 0
+
+    # a query encoded with the model of a generation swapped out meanwhile
+    # is encoded again; self.model is read under the lock, so queries that
+    # wait for the encoder do not load the previous model again
+    def search(self, query, threshold, count, filters):
+        start = time.perf_counter()
+        with self.encoding:
+            self.searches += 1
+        while True:
+            with self.encoding:
+                model = self.model
+                vector = embedding.embed_query(query, model)
+            try:
+                rows = self.backends.search(vector, threshold, count, filters, model)
+                break
+            except search.ModelChanged as e:
+                self.model = e.model
+        self.latencies.append(time.perf_counter() - start)
+        return rows
+
+    def health(self):
+        latencies = 1000 * np.asarray(self.latencies or [0])
+        return {
+            'backend': self.backends.name,
+            'model': self.model,
+            'searches': self.searches,
+            'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+        }
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, clients may send many queries on one connection
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, data):
+        body = json.dumps(data, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.reply(404, {'error': 'not found'})
+            return
+        self.reply(200, self.server.service.health())
+
+    def do_POST(self):
+        if self.path != '/search':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(body, dict) or not isinstance(body.get('query'), str):
+                raise ValueError('query has to be a string')
+            rows = self.server.service.search(body['query'], float(body.get('threshold', 0)), int(body.get('count', 5)), body.get('filters'))
+        except (KeyError, TypeError, ValueError, psycopg2.DataError) as e:
+            self.reply(400, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        except psycopg2.Error as e:
+            self.reply(503, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        except Exception as e:
+            # a reply instead of a dropped connection, which clients take
+            # for a service that is not running
+            self.reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        self.reply(200, {'rows': [
+            {'id': id, 'content': content, 'url': url, 'similarity': similarity, 'urls': urls}
+            for id, content, url, similarity, urls in rows
+        ]})
+
+    # unix socket peers have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # a socket left by a service that did not shut down
+        if os.path.exists(self.server_address) and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        os.unlink(self.server_address)
+
+def make_server(service, address=None):
+    target = search_client.address(address or config.SEARCH_SERVICE)
+    if isinstance(target, str):
+        server = UnixServer(target, Handler)
+    else:
+        server = http.server.ThreadingHTTPServer(target, Handler)
+    server.service = service
+    return server
+
+def serve(address=None):
+    service = Service()
+    server = make_server(service, address)
+    print('serving %s searches with %s on %s' % (service.backends.name, service.model, address or config.SEARCH_SERVICE))
+    # stopped by a service manager like by ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.backends.close()
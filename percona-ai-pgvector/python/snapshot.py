@@ -0,0 +1,280 @@
+# compact snapshot of the ingested chunks that numpy can memory-map: a
+# directory with
+#   meta.json             row counts, vector dtype, dictionaries, generation
+#   ids.npy               int64 chunk ids, the rows with a vector first
+#   embeddings.npy        float32 or float16, one row per chunk with a vector
+#   content.bin, url.bin  utf-8 text, with int64 offsets in <name>.offsets.npy
+#   source.npy, source_type.npy, repo.npy, branch.npy
+#                         int32 codes into the meta.json dictionaries, -1 for none
+#   content_hash.npy      uint8 sha256 digests, one row of 32 per chunk, and
+#   has_content_hash.npy  bool, false for chunks without one
+#   published_at.npy      int64 microseconds since the unix epoch
+#   chunk_no.npy, simhash.npy, duplicate_of.npy
+#                         int64; NULL (the smallest int64) stands for none
+#   state.json            ingest_state and docs_state rows
+# Exported from either layout (config.NORMALIZED_LAYOUT) and imported into
+# either one
+import json
+import os
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import config
+import chunk_cache
+import documents
+import docs_git
+import loader
+import state
+
+FORMAT = 2
+NULL = np.iinfo(np.int64).min
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+STRINGS = ['content', 'url']
+CODES = ['source', 'source_type', 'repo', 'branch']
+INTEGERS = ['chunk_no', 'simhash', 'duplicate_of']
+
+# exported columns and the tables they come from, per layout; rows are
+# counted over the same joins
+ROWS = {
+    False: (
+        'c.id, c.content, c.url, c.source, c.content_hash, c.source_type, c.repo, c.branch, c.published_at, '
+        'NULL::int, c.simhash, c.duplicate_of, c.embedding',
+        'perconavec c',
+    ),
+    True: (
+        'c.id, t.content, d.url, c.source, c.content_hash, d.source_type, d.repo, d.branch, d.published_at, '
+        'c.chunk_no, c.simhash, c.duplicate_of, c.embedding',
+        'perconavec c JOIN documents d ON d.id = c.doc_id JOIN chunk_texts t ON t.id = c.id',
+    ),
+}
+
+def microseconds(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def timestamp(value):
+    return EPOCH + timedelta(microseconds=value)
+
+# utf-8 strings appended to one file, offsets kept in memory
+class StringWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + '.bin', 'wb')
+        self.offsets = [0]
+
+    def add(self, text):
+        data = (text or '').encode('utf-8')
+        self.file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        self.file.close()
+        np.save(self.path + '.offsets.npy', np.asarray(self.offsets, dtype=np.int64))
+
+class CodeWriter:
+    def __init__(self):
+        self.values = {}
+        self.codes = []
+
+    def add(self, value):
+        if value is None:
+            self.codes.append(-1)
+        else:
+            self.codes.append(self.values.setdefault(value, len(self.values)))
+
+def read_state(cur):
+    cur.execute('SELECT url, lastmod, etag, last_modified, content_hash FROM ingest_state')
+    pages = [dict(zip(['url', 'lastmod', 'etag', 'last_modified', 'content_hash'], row)) for row in cur.fetchall()]
+    cur.execute('SELECT repo, branch, commit FROM docs_state')
+    commits = [dict(zip(['repo', 'branch', 'commit'], row)) for row in cur.fetchall()]
+    return {'ingest_state': pages, 'docs_state': commits}
+
+def read_generation(cur):
+    cur.execute("SELECT to_regclass('generation')")
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute('SELECT embed_model, chunk_tokens, chunk_overlap_tokens FROM generation')
+    row = cur.fetchone()
+    return dict(zip(['embed_model', 'chunk_tokens', 'chunk_overlap_tokens'], row)) if row else None
+
+# streams perconavec through a server side cursor into path, in one
+# repeatable read transaction so counts and rows agree; conn needs pgvector's
+# register_vector
+def export(conn, path, dtype=np.float32, batch_size=config.COPY_BATCH_SIZE):
+    os.makedirs(path, exist_ok=True)
+    # ivf lists trained on a previous export, see local_search.py
+    for name in os.listdir(path):
+        if name.startswith('ivf-') and name.endswith('.npz'):
+            os.unlink(os.path.join(path, name))
+    conn.commit()
+    with conn.cursor() as cur:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        columns, tables = ROWS[config.NORMALIZED_LAYOUT]
+        cur.execute('SELECT count(*), count(c.embedding) FROM %s' % tables)
+        rows, vectors = cur.fetchone()
+        saved = read_state(cur)
+        generation = read_generation(cur)
+    ids = np.empty(rows, dtype=np.int64)
+    embeddings = np.lib.format.open_memmap(os.path.join(path, 'embeddings.npy'), mode='w+', dtype=dtype, shape=(vectors, config.EMBED_DIMENSIONS))
+    hashes = np.zeros((rows, 32), dtype=np.uint8)
+    has_hash = np.zeros(rows, dtype=bool)
+    published = np.full(rows, NULL, dtype=np.int64)
+    integers = {name: np.full(rows, NULL, dtype=np.int64) for name in INTEGERS}
+    strings = {name: StringWriter(os.path.join(path, name)) for name in STRINGS}
+    codes = {name: CodeWriter() for name in CODES}
+    with conn.cursor(name='snapshot') as cur:
+        cur.itersize = batch_size
+        cur.execute('SELECT %s FROM %s ORDER BY c.embedding IS NULL, c.id' % (columns, tables))
+        i = written = 0
+        for id, content, url, source, content_hash, source_type, repo, branch, published_at, chunk_no, simhash, duplicate_of, embedding in cur:
+            if i == rows or (embedding is not None and written == vectors):
+                raise RuntimeError('perconavec changed during the export')
+            ids[i] = id
+            if embedding is not None:
+                embeddings[written] = chunk_cache.as_array(embedding)
+                written += 1
+            strings['content'].add(content)
+            strings['url'].add(url)
+            for name, value in zip(CODES, (source, source_type, repo, branch)):
+                codes[name].add(value)
+            if content_hash is not None:
+                hashes[i] = np.frombuffer(bytes.fromhex(content_hash), dtype=np.uint8)
+                has_hash[i] = True
+            if published_at is not None:
+                published[i] = microseconds(published_at)
+            for name, value in zip(INTEGERS, (chunk_no, simhash, duplicate_of)):
+                if value is not None:
+                    integers[name][i] = value
+            i += 1
+    conn.commit()
+    # the vectors are the first rows, their count is what was written
+    if written != vectors:
+        raise RuntimeError('perconavec changed during the export')
+    embeddings.flush()
+    del embeddings
+    for writer in strings.values():
+        writer.close()
+    np.save(os.path.join(path, 'ids.npy'), ids[:i])
+    np.save(os.path.join(path, 'content_hash.npy'), hashes[:i])
+    np.save(os.path.join(path, 'has_content_hash.npy'), has_hash[:i])
+    np.save(os.path.join(path, 'published_at.npy'), published[:i])
+    for name, values in integers.items():
+        np.save(os.path.join(path, name + '.npy'), values[:i])
+    for name, writer in codes.items():
+        np.save(os.path.join(path, name + '.npy'), np.asarray(writer.codes, dtype=np.int32))
+    meta = {
+        'format': FORMAT,
+        'rows': i,
+        'vectors': written,
+        'dimensions': config.EMBED_DIMENSIONS,
+        'dtype': np.dtype(dtype).name,
+        'dictionaries': {name: list(writer.values) for name, writer in codes.items()},
+        'generation': generation,
+        'exported_at': datetime.now(timezone.utc).isoformat(),
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    with open(os.path.join(path, 'state.json'), 'w') as f:
+        json.dump(saved, f)
+    return meta
+
+# a snapshot directory, memory-mapped: nothing is read before it is used
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != FORMAT:
+            raise ValueError('snapshot format %s, expected %s' % (self.meta['format'], FORMAT))
+        self.ids = self.load('ids')
+        self.embeddings = self.load('embeddings')
+        self.offsets = {name: self.load(name + '.offsets') for name in STRINGS}
+        self.blobs = {name: self.load_blob(name) for name in STRINGS}
+        self.codes = {name: self.load(name) for name in CODES}
+        self.content_hash = self.load('content_hash')
+        self.has_content_hash = self.load('has_content_hash')
+        self.published_at = self.load('published_at')
+        self.integers = {name: self.load(name) for name in INTEGERS}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def load_blob(self, name):
+        file = os.path.join(self.path, name + '.bin')
+        # numpy cannot map an empty file
+        if os.path.getsize(file) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(file, dtype=np.uint8, mode='r')
+
+    def string(self, name, i):
+        offsets = self.offsets[name]
+        return bytes(self.blobs[name][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def code(self, name, i):
+        code = self.codes[name][i]
+        return None if code < 0 else self.meta['dictionaries'][name][code]
+
+    def integer(self, name, i):
+        value = int(self.integers[name][i])
+        return None if value == NULL else value
+
+    # chunk dicts as loader.copy_rows takes them
+    def rows(self, start, stop):
+        rows = []
+        for i in range(start, stop):
+            published = int(self.published_at[i])
+            rows.append({
+                'id': int(self.ids[i]),
+                'content': self.string('content', i),
+                'url': self.string('url', i),
+                'source': self.code('source', i),
+                'content_hash': bytes(self.content_hash[i]).hex() if self.has_content_hash[i] else None,
+                'embedding': self.embeddings[i] if i < len(self.embeddings) else None,
+                'source_type': self.code('source_type', i),
+                'repo': self.code('repo', i),
+                'branch': self.code('branch', i),
+                'published_at': None if published == NULL else timestamp(published),
+                'chunk_no': self.integer('chunk_no', i),
+                'simhash': self.integer('simhash', i),
+                'duplicate_of': self.integer('duplicate_of', i),
+            })
+        return rows
+
+    def state(self):
+        with open(os.path.join(self.path, 'state.json')) as f:
+            return json.load(f)
+
+# documents rows for the urls of a batch, see documents.save
+def document_pages(rows):
+    pages = {}
+    for row in rows:
+        pages[row['url']] = {'url': row['url'], 'source': row['source'], 'kind': row['source_type'], 'repo': row['repo'], 'branch': row['branch'], 'published_at': row['published_at']}
+    return list(pages.values())
+
+# loads a snapshot into an empty provisioned schema with the COPY loader, one
+# commit per batch. Ids and duplicate_of links are kept, the id sequence is
+# moved past them and the saved page state comes along, so the next 02-put.py
+# run only ingests what changed since the export
+def load(conn, snap, batch_size=config.COPY_BATCH_SIZE):
+    for start in range(0, len(snap), batch_size):
+        rows = snap.rows(start, min(start + batch_size, len(snap)))
+        if config.NORMALIZED_LAYOUT:
+            with conn.cursor() as cur:
+                ids = documents.save(cur, document_pages(rows))
+            for row in rows:
+                row['doc_id'] = ids[row['url']]
+        loader.copy_rows(conn, rows)
+    saved = snap.state()
+    with conn.cursor() as cur:
+        cur.execute("SELECT setval(pg_get_serial_sequence('perconavec', 'id'), greatest(max(id), 1)) FROM perconavec")
+        if saved['ingest_state']:
+            state.save_state(cur, saved['ingest_state'])
+        for commit in saved['docs_state']:
+            docs_git.save_commit(cur, commit['repo'], commit['branch'], commit['commit'])
+        generation = snap.meta['generation']
+        if generation:
+            cur.execute('UPDATE generation SET embed_model = %s, chunk_tokens = %s, chunk_overlap_tokens = %s',
+                        (generation['embed_model'], generation['chunk_tokens'], generation['chunk_overlap_tokens']))
+    conn.commit()
@@ -0,0 +1,28 @@
+# per-url ingestion state used to skip unchanged pages
+import hashlib
+from psycopg2.extras import execute_values
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# every url, or only the given ones
+def load_state(conn, urls=None):
+    with conn.cursor() as cur:
+        if urls is None:
+            cur.execute('SELECT url, lastmod, etag, last_modified, content_hash FROM ingest_state')
+        else:
+            cur.execute('SELECT url, lastmod, etag, last_modified, content_hash FROM ingest_state WHERE url = ANY(%s)', (urls,))
+        return {row[0]: {'lastmod': row[1], 'etag': row[2], 'last_modified': row[3], 'content_hash': row[4]} for row in cur}
+
+# pages are dicts with url, lastmod, etag, last_modified and content_hash
+def save_state(cur, pages):
+    execute_values(cur, """
+        INSERT INTO ingest_state (url, lastmod, etag, last_modified, content_hash)
+        VALUES %s
+        ON CONFLICT (url) DO UPDATE SET
+          lastmod = excluded.lastmod,
+          etag = excluded.etag,
+          last_modified = excluded.last_modified,
+          content_hash = excluded.content_hash,
+          updated_at = now()
+    """, [(p['url'], p['lastmod'], p['etag'], p['last_modified'], p['content_hash']) for p in pages])